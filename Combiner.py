@@ -1,24 +1,25 @@
-import xml.etree.ElementTree as ET
-import HTMLParser
-import json
 import numpy as np
 import os.path
-from time import strptime,mktime
 from math import floor,sqrt
-
-XMLNS = "{http://neutrons.ornl.gov/SNS/DAS/runinfo_v4_3}"
+import runcatalog
+import dataset
+from reader import PelFile
 
 def load(paths,filter=None):
+    """Sort runs by the instrument configuration in their manifests
+
+    The manifests come from the run catalog, which reads the runs it
+    hasn't seen before on a pool of threads.
+
+    """
     currents = set([])#List of the configurations of the instrument
     runsets = {}#Directionary of lists of run nodes, indexed by their instrument configuration
 
 #
-    for path in paths:
-        print(path)
+    print("Loading " + str(len(paths)) + " runs")
+    for (path,run) in zip(paths,runcatalog.shared().runs(paths)):
         base = os.path.dirname(path)
-        text = ET.parse(path).getroot().find(".//"+XMLNS+"Notes").text 
-        text = HTMLParser.HTMLParser().unescape(text)
-        manifest = json.loads(text)
+        manifest = run.manifest if run is not None else None
         
 ##        if ((filter is not None) and 
 ##            (floor(float(manifest['triangle1'])) != filter)):
@@ -47,77 +48,284 @@ def load(paths,filter=None):
             runsets[current]=[path]
     return runsets
 
-def save(path,minmon,keys,runsets):
-    runs = [x for key in keys for x in runsets[key]]
-#
-    mon = np.zeros((50001,),dtype=np.int32)
-#
-    tottime = 0
-    detcount=0
-#
-    format1 = "%Y-%m-%dT%H:%M:%S-04:00"
-    format2 = "%Y-%m-%dT%H:%M:%S-04:00-04:00"
-#
-    with open(path+"_neutron_event.dat","wb") as outfile:
-        for r in runs:
-            monpath = r[:-11] + "bmon_histo.dat"
-            detpath = r[:-11] + "neutron_event.dat"
-#
-            starttime = strptime(ET.parse(r).getroot().find(".//"+XMLNS+"StartTime").text.strip(),format1)
-            stoptime = strptime(ET.parse(r).getroot().find(".//"+XMLNS+"StopTime").text.strip(),format2)
+EVENTSIZE = 8 #Bytes in an event, an int32 time and an int32 position
+BUFFER = 2**24 #Bytes copied at once when joining event files
 
-            time = mktime(stoptime)-mktime(starttime)
+def copyevents(infile,outfile,events,buffer=BUFFER):
+    """Copy events whole events from one event file to another
 
-#
-            with open(monpath,"r") as infile:
-                montemp = np.fromfile(infile,dtype=np.int32)
+    Only buffer bytes are held at once, however big the file.  A
+    trailing partial event is left behind, so the events of the next
+    file stay aligned.
 
-            moncount = 1.*np.sum(montemp)
-            print "Run number: " + str(r[-17:-12])
-            print "Time: " + str(time)
+    """
+    remaining = events*EVENTSIZE
+    while remaining > 0:
+        block = infile.read(min(buffer,remaining))
+        if not block:
+            break
+        outfile.write(block)
+        remaining -= len(block)
 
+def member(r,run):
+    """The record of a screened run, before it is decided on
 
-#
-            #Fixed for enabling dead run substraction 04/01/2013 done by Radian 
-            if time <= 0 or ((moncount/time < minmon-20 or \
-                              moncount/time>minmon+20) and minmon >0):
-                print ":::: SKIPPING RUN: " + str(r[-17:-12]) + " ::::\n"
-                print moncount/time
-                print time
-                continue
+    The counts come from the run's entry in the run catalog, run,
+    which is None if the run couldn't be read.
 
-            print "Monitor counts: " + str(moncount)
-            print "Monitor count rate: " + str(round(moncount/time,2))
+    """
+    record = {"runinfo":os.path.abspath(r),
+              "events":os.path.abspath(r[:-11] + "neutron_event.dat"),
+              "monitor":os.path.abspath(r[:-11] + "bmon_histo.dat"),
+              "time":None,
+              "monitor count":None,
+              "detector count":None,
+              "monitor rate":None,
+              "detector rate":None,
+              "ratio":None,
+              "ratio error":None,
+              "included":False,
+              "reason":None}
+    if run is not None:
+        record["time"] = run.duration
+        record["monitor count"] = run.monitor
+        record["detector count"] = run.events
+    return record
 
-            mon += montemp
-            tottime += time
+def decide(minmon,record):
+    """Decide whether to include a screened run, printing its details"""
+    r = record["runinfo"]
+    time = record["time"]
+    print "Run number: " + str(r[-17:-12])
+    print "Time: " + str(time)
+    if record["monitor count"] is None:
+        print "#### UNREADABLE RUN: " + str(r[-17:-12]) + " ####\n"
+        record["reason"] = "unreadable"
+        return record
+    moncount = np.float64(record["monitor count"])
 
 #
-            with open(detpath,"rb") as infile:
-                dettemp = np.fromfile(infile,count=-1)
-                dc = 1.*len(dettemp)
-                dcr = round(dc/moncount,2)
-                dcrerr = sqrt(dc/(moncount**2) + (dc**2)/(moncount**3))
-                print "Detector counts: " + str(dc)
-                print "Detector count rate: " + str(round(dc/time,2))
-                print "Detector counts/Monitor counts: " + str(dcr) + \
-                      " +/- " + str(dcrerr) + "\n"
-                if dcr <= 0:# or dcrerr/dcr > 0.02:
-                    print "#### SKIPPING RUN: " + str(r[-17:-12]) + " ####\n"
-                    mon -= montemp
-                    continue
+    #Fixed for enabling dead run substraction 04/01/2013 done by Radian 
+    if time is None or time <= 0 or ((moncount/time < minmon-20 or \
+                      moncount/time>minmon+20) and minmon >0):
+        print ":::: SKIPPING RUN: " + str(r[-17:-12]) + " ::::\n"
+        if time:
+            record["monitor rate"] = float(moncount/time)
+            print moncount/time
+        print time
+        record["reason"] = "monitor rate"
+        return record
+    record["monitor rate"] = float(moncount/time)
 
-#
-                detcount += len(dettemp)
-                dettemp.tofile(outfile)
-                del dettemp
+    print "Monitor counts: " + str(moncount)
+    print "Monitor count rate: " + str(round(moncount/time,2))
 
 #
-    with open(path+"_bmon_histo.dat","wb") as stream:
-        mon.tofile(stream)
+    if record["detector count"] is None:
+        print "#### UNREADABLE RUN: " + str(r[-17:-12]) + " ####\n"
+        record["reason"] = "unreadable"
+        return record
+    dc = 1.*record["detector count"]
+    dcr = round(dc/moncount,2)
+    dcrerr = sqrt(dc/(moncount**2) + (dc**2)/(moncount**3))
+    record["detector rate"] = dc/time
+    record["ratio"] = float(dc/moncount)
+    record["ratio error"] = float(dcrerr)
+    print "Detector counts: " + str(dc)
+    print "Detector count rate: " + str(round(dc/time,2))
+    print "Detector counts/Monitor counts: " + str(dcr) + \
+          " +/- " + str(dcrerr) + "\n"
+    if dcr <= 0:# or dcrerr/dcr > 0.02:
+        print "#### SKIPPING RUN: " + str(r[-17:-12]) + " ####\n"
+        record["reason"] = "detector rate"
+        return record
+    record["included"] = True
+    return record
+
+def screen(minmon,runs):
+    """Decide which runs to combine before any data is moved
+
+    The monitor and detector totals of every run are taken from the
+    run catalog, which reads the runs it hasn't seen before at the
+    same time on a pool of threads.  Returns a list holding a record
+    of each run, with its times, counts and rates, whether it is
+    included and, if it isn't, the reason.
+
+    """
+    catalog = runcatalog.shared().runs(runs)
+    return [decide(minmon,member(r,run)) for (r,run) in zip(runs,catalog)]
+
+REPORT = "_screening.csv" #The screening decisions of a combination
+COLUMNS = ["runinfo","time","monitor count","monitor rate","detector count",
+           "detector rate","ratio","ratio error","included","reason"]
+
+def report(path,members):
+    """Write the screening decisions of a combination to path + REPORT"""
+    def cell(value):
+        if value is None:
+            return ""
+        return str(value)
+    with open(path+REPORT,"w") as stream:
+        stream.write(",".join(COLUMNS)+"\n")
+        for m in members:
+            stream.write(",".join([cell(m[c]) for c in COLUMNS])+"\n")
+    rejected = [m for m in members if not m["included"]]
+    print "Screened " + str(len(members)) + " runs, rejected " + \
+          str(len(rejected)) + ", see " + path+REPORT
+
+def included(members):
+    """The totals of the included runs: monitor spectrum, time and events"""
+    mon = np.zeros((50001,),dtype=np.int32)
+    tottime = 0
+    detcount = 0
+    for m in members:
+        if m["included"]:
+            mon += np.fromfile(m["monitor"],dtype=np.int32)
+            tottime += m["time"]
+            detcount += m["detector count"]
+    return (mon,tottime,detcount)
+
+def summary(mon,detcount,tottime):
+    """Print the totals of a combination"""
     print "Total Monitor Counts = " + str(np.sum(mon))
     print "Total Detector Counts = " + str(detcount)
     print "Total Time = " + str(tottime)
     if tottime > 0:
         print "Monitor Count Rate = " + str(np.sum(mon)/tottime)
         print "Detector Count Rate = " + str(detcount/tottime)
+
+RUNS = "_runs.json" #Sidecar listing the runs in the files written by save
+
+def stamps(r):
+    """The sizes and modification times of the files of a run"""
+    return [None if s is None else list(s)
+            for s in [runcatalog.stamp(p)
+                      for p in (r,)+runcatalog.datapaths(r)]]
+
+def previous(path,minmon,runs):
+    """The records of the runs already saved at path which can be kept
+
+    An earlier save can be added to if it used the same monitor rate
+    cut, none of its runs have been dropped from runs or changed since,
+    and its files are the size its sidecar says.  Otherwise None is
+    returned and the files must be written from scratch.  Runs which
+    couldn't be read, such as runs still in progress, are left out, so
+    that they are screened again once they are finished.
+
+    """
+    try:
+        descriptor = dataset.read(path+RUNS)
+    except (IOError,OSError,ValueError,KeyError):
+        return None
+    members = [m for m in descriptor["runs"] if m["reason"] != "unreadable"]
+    wanted = set([os.path.abspath(r) for r in runs])
+    if descriptor.get("minmon") != minmon:
+        return None
+    for m in members:
+        if m["runinfo"] not in wanted or stamps(m["runinfo"]) != m["stamps"]:
+            return None
+    events = sum([m["detector count"] for m in members if m["included"]])
+    if runcatalog.stamp(path+"_bmon_histo.dat") is None or \
+       runcatalog.stamp(path+"_neutron_event.dat") is None or \
+       os.path.getsize(path+"_neutron_event.dat") != events*EVENTSIZE:
+        return None
+    return members
+
+def save(path,minmon,keys,runsets):
+    """Join the events and monitor spectra of the chosen runs into new files
+
+    The runs which were screened are recorded in path + RUNS.  When
+    save is run again over a longer list of runs, only the new runs
+    are screened and appended to the files, unless the monitor rate
+    cut has changed or an earlier run has been dropped or rewritten,
+    in which case the files are rebuilt.
+
+    """
+    runs = [x for key in keys for x in runsets[key]]
+    members = previous(path,minmon,runs)
+    #The sidecar only describes the files once they're finished
+    if os.path.exists(path+RUNS):
+        os.remove(path+RUNS)
+#
+    if members is None:
+        members = []
+        mode = "wb"
+        mon = np.zeros((50001,),dtype=np.int32)
+    else:
+        mode = "ab"
+        mon = np.fromfile(path+"_bmon_histo.dat",dtype=np.int32)
+        print "Keeping " + str(len(members)) + " runs from the last export"
+    known = set([m["runinfo"] for m in members])
+    runs = [r for r in runs if os.path.abspath(r) not in known]
+#
+    tottime = sum([m["time"] for m in members if m["included"]])
+    detcount = sum([m["detector count"] for m in members if m["included"]])
+#
+    fresh = screen(minmon,runs)
+    for m in fresh:
+        m["stamps"] = stamps(m["runinfo"])
+    members += fresh
+    report(path,members)
+    (newmon,newtime,newcount) = included(fresh)
+    mon += newmon
+    tottime += newtime
+    detcount += newcount
+#
+    #The events are streamed across rather than read into memory
+    with open(path+"_neutron_event.dat",mode) as outfile:
+        for m in fresh:
+            if m["included"]:
+                with open(m["events"],"rb") as infile:
+                    copyevents(infile,outfile,m["detector count"])
+
+#
+    with open(path+"_bmon_histo.dat","wb") as stream:
+        mon.tofile(stream)
+    dataset.write(path+RUNS,members,minmon=minmon)
+    #A virtual dataset left by an earlier export would hide these files
+    for suffix in (dataset.SUFFIX,dataset.CUBESUFFIX):
+        if os.path.exists(path+suffix):
+            os.remove(path+suffix)
+    summary(mon,detcount,tottime)
+
+def describe(path,minmon,keys,runsets):
+    """Write a virtual combined dataset instead of copying the runs
+
+    The same runs are chosen as by save, but only a dataset
+    descriptor listing them is written, to path + dataset.SUFFIX.
+    PelFile and MonFile read it as the combined files.
+
+    """
+    runs = [x for key in keys for x in runsets[key]]
+    members = screen(minmon,runs)
+    report(path,members)
+    (mon,tottime,detcount) = included(members)
+    dataset.write(path+dataset.SUFFIX,members,minmon=minmon)
+    if os.path.exists(path+dataset.CUBESUFFIX):
+        os.remove(path+dataset.CUBESUFFIX)
+    summary(mon,detcount,tottime)
+
+def histogram(path,minmon,keys,runsets):
+    """Write a combined cube instead of copying the runs
+
+    The same runs are chosen as by save, but each is histogrammed on
+    its own and only the summed cube and monitor spectrum are written,
+    to path + dataset.CUBESUFFIX.  The cubes go through PelFile's
+    histogram cache when it has one, so a run which has been
+    histogrammed before is never read again, however many exports it
+    takes part in.
+
+    """
+    runs = [x for key in keys for x in runsets[key]]
+    members = screen(minmon,runs)
+    report(path,members)
+    (mon,tottime,detcount) = included(members)
+    cube = np.zeros((128,16,PelFile.binning.resolution),dtype=np.float64)
+    for m in members:
+        if m["included"]:
+            cube += PelFile(m["events"]).make3d()
+    dataset.writecube(path+dataset.CUBESUFFIX,cube,mon,members,
+                      PelFile.binning,PelFile.tubemap,minmon=minmon)
+    if os.path.exists(path+dataset.SUFFIX):
+        os.remove(path+dataset.SUFFIX)
+    summary(mon,detcount,tottime)
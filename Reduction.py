@@ -1,13 +1,39 @@
-from reader import PelFile
+from reader import PelFile, printstats
+from histcache import HistCache
+from binning import DEFAULT as BINNING
 from monfile import MonFile
 import matplotlib.pyplot as plt
 import Combiner
+import dataset
+import runcatalog
 import numpy as np
 from optparse import OptionParser
+import multiprocessing
 import os
 
 basedir = "C:/userfiles/EXP011/"
-RESOLUTION = 400
+RESOLUTION = BINNING.resolution
+
+def combined(run,name,kind):
+    """The path of a combined file, such as neutron_event.dat, from an export
+
+    If the export wrote a combined cube or a virtual dataset, that
+    stands in for the file.
+
+    """
+    base = basedir + "SESAME_%i/" % run + name
+    for suffix in (dataset.CUBESUFFIX,dataset.SUFFIX):
+        if os.path.exists(base + suffix):
+            return base + suffix
+    return base + "_" + kind
+
+def writer(virtual=False,histogram=False):
+    """The Combiner function which writes the combinations of an export"""
+    if histogram:
+        return Combiner.histogram
+    if virtual:
+        return Combiner.describe
+    return Combiner.save
 
 def load(runs,current=None):
     paths = [basedir + "SESAME_%i/SESAME_%i_runinfo.xml"
@@ -15,67 +41,101 @@ def load(runs,current=None):
     return Combiner.load(paths,current)
 
 
+def partition(keys,classify):
+    """Sort instrument configurations into groups in a single pass
+
+    classify is called once on each configuration and returns the
+    name of its group, or None to leave it out.  Returns a dictionary
+    of the list of configurations in each group, indexed by name.
+
+    """
+    groups = {}
+    for key in keys:
+        name = classify(key)
+        if name is not None:
+            groups.setdefault(name,[]).append(key)
+    return groups
+
+def combine(job):
+    """Write one combination of an export, as given by writeall"""
+    (write,label,path,minmon,keys,runsets,cache) = job
+    PelFile.cache = cache
+    if label is not None:
+        print "-------------- " + label + " state --------------"
+    write(path,minmon,keys,runsets)
+
+def writeall(write,jobs,runsets,workers=1):
+    """Write the combinations of an export at once
+
+    Each job is a (label,path,minmon,keys) tuple, where label names
+    the state for the log, or is None, and keys are the configurations
+    whose runs are combined into path.  The run catalog is brought up
+    to date for every run first, so that the combinations, which are
+    written in a pool of worker processes, only look their runs up.
+
+    """
+    paths = [p for (_,_,_,keys) in jobs for key in keys for p in runsets[key]]
+    runcatalog.shared().runs(paths)
+    tasks = [(write,label,path,minmon,keys,
+              dict([(key,runsets[key]) for key in keys]),PelFile.cache)
+             for (label,path,minmon,keys) in jobs]
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            combine(task)
+        return
+    pool = multiprocessing.Pool(min(workers,len(tasks)))
+    try:
+        pool.map(combine,tasks)
+    finally:
+        pool.close()
+        pool.join()
+
 def export(runs,sortby=None,flipper=0,minmon=8,current=None,\
-           filter=None,watch=None):
+           filter=None,watch=None,virtual=False,histogram=False,workers=1):
     data = load(runs,current)
+    write = writer(virtual,histogram)
 
     keys = data.keys()
     print keys
 #
 
-    if sortby is None:
-        values = [""]
-    else:
-        if filter is None:
-            values = set([x[sortby] for x in keys])
-        else:
-            values = [filter]
-#
-
     base = basedir + "SESAME_%i/" % runs[-1]
 #
+    if current==None:
+        titleend=""
+    else:
+        titleend="_current="+str(current)
+#
 
-    for value in values:
-        if type(value) is not str:
-            value = normalize_name(value)
-        ups = [x for x in keys if (flipper is None or x[flipper] < 0) \
-               and (watch is None or x[choices[watch]]==current) \
-               and (sortby is None or normalize_name(x[sortby]) == value)]
-        downs = [x for x in keys if (flipper is not None and x[flipper] > 0)  \
-                and (watch is None or x[choices[watch]]==current) \
-                and (sortby is None or normalize_name(x[sortby]) == value)]
-        sames = [x for x in keys if (flipper is not None and x[flipper] == 0)  \
-                and (watch is None or x[choices[watch]]==current) \
-                and (sortby is None or normalize_name(x[sortby]) == value)]
-#
-        if filter is not None:
-            value = "" #Don't put values on files when we're only running a single export
-#
-        if current==None:
-            titleend=""
+    def classify(x):
+        if watch is not None and x[choices[watch]]!=current:
+            return None
+        if sortby is None:
+            value = ""
         else:
-            titleend="_current="+str(current)
-#
-        if ups == [] and downs == []:
-            Combiner.save(base+value+"Combined"+titleend,
-                          0,
-                          sames,
-                          data)
-        if ups != []:
-            print "-------------- Up state --------------"
-            Combiner.save(base+value+"up"+titleend,
-                          minmon,
-                          ups,
-                          data)
-        if downs != []:
-            print "-------------- Down state --------------"
-            Combiner.save(base+value+"down"+titleend,
-                          minmon,
-                          downs,
-                          data)
-        
-            
+            value = normalize_name(x[sortby])
+            if filter is not None:
+                if value != normalize_name(filter):
+                    return None
+                value = "" #Don't put values on files when we're only running a single export
+        if flipper is None or x[flipper] < 0:
+            return (value,"up")
+        if x[flipper] > 0:
+            return (value,"down")
+        return (value,"same")
+    groups = partition(keys,classify)
+#
 
+    jobs = []
+    for value in sorted(set([v for (v,_) in groups.keys()])):
+        if (value,"up") not in groups and (value,"down") not in groups:
+            jobs.append((None,base+value+"Combined"+titleend,0,
+                         groups[(value,"same")]))
+        for (state,label) in (("up","Up"),("down","Down")):
+            if (value,state) in groups:
+                jobs.append((label,base+value+state+titleend,minmon,
+                             groups[(value,state)]))
+    writeall(write,jobs,data,workers)
 
 
 def plot_2d_range(data,rnge=None,steps=100,mask=None):
@@ -96,8 +156,8 @@ def plot_2d_range(data,rnge=None,steps=100,mask=None):
     plt.plot(xs,ys,"r*")
     plt.show()
 def get_2d_int(run,name):
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"_bmon_histo.dat",False)
+    p = PelFile(combined(run,name,"neutron_event.dat"))
+    mon = MonFile(combined(run,name,"bmon_histo.dat"),False)
     return np.sum(p.make3d(),axis=2) / np.sum(mon.spec)    
 
 def plot_int_range(run):
@@ -112,15 +172,16 @@ def plot_pol_range(run,mask=None):
     
     
 def getIntegratedSpectra(run,name,mins,maxs,mask):
+    band = slice(BINNING.index(2.0),BINNING.index(4.5))
     name = normalize_name(name)
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"up_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"up_bmon_histo.dat",False)
-    up = np.sum(p.make1d(mins,maxs,mask)[40:90])
+    p = PelFile(combined(run,name+"up","neutron_event.dat"))
+    mon = MonFile(combined(run,name+"up","bmon_histo.dat"),False)
+    up = np.sum(p.make1d(mins,maxs,mask)[band])
     uperr = np.sqrt(up)/np.sum(mon.spec)
     up /= np.sum(mon.spec)
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"down_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"down_bmon_histo.dat",False)
-    down = np.sum(p.make1d(mins,maxs,mask)[40:90])
+    p = PelFile(combined(run,name+"down","neutron_event.dat"))
+    mon = MonFile(combined(run,name+"down","bmon_histo.dat"),False)
+    down = np.sum(p.make1d(mins,maxs,mask)[band])
     downerr = np.sqrt(down)/np.sum(mon.spec)
     down /= np.sum(mon.spec)
 
@@ -135,13 +196,13 @@ def normalize_name(name):
 
 def spectrum(run,name,mins=(0,0),maxs=(16,128),mask=None):
     name = normalize_name(name)
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"up_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"up_bmon_histo.dat",False)
+    p = PelFile(combined(run,name+"up","neutron_event.dat"))
+    mon = MonFile(combined(run,name+"up","bmon_histo.dat"),False)
     up = p.make1d(mins,maxs,mask)
     uperr = np.sqrt(up)/np.sum(mon.spec)
     up /= np.sum(mon.spec)
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"down_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"down_bmon_histo.dat",False)
+    p = PelFile(combined(run,name+"down","neutron_event.dat"))
+    mon = MonFile(combined(run,name+"down","bmon_histo.dat"),False)
     down = p.make1d(mins,maxs,mask)
     downerr = np.sqrt(down)/np.sum(mon.spec)
     down /= np.sum(mon.spec)
@@ -150,13 +211,13 @@ def spectrum(run,name,mins=(0,0),maxs=(16,128),mask=None):
 
 def errspectrum(run,name,mins=(0,0),maxs=(16,128),mask=None):
     name = normalize_name(name)
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"up_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"up_bmon_histo.dat",False)
+    p = PelFile(combined(run,name+"up","neutron_event.dat"))
+    mon = MonFile(combined(run,name+"up","bmon_histo.dat"),False)
     up = p.make1d(mins,maxs,mask)
     uperr = np.sqrt(up)/np.sum(mon.spec)
     up /= np.sum(mon.spec)
-    p = PelFile(basedir+"SESAME_%i/" % run + name+"down_neutron_event.dat")
-    mon = MonFile(basedir+"SESAME_%i/" % run + name+"down_bmon_histo.dat",False)
+    p = PelFile(combined(run,name+"down","neutron_event.dat"))
+    mon = MonFile(combined(run,name+"down","bmon_histo.dat"),False)
     down = p.make1d(mins,maxs,mask)
     downerr = np.sqrt(down)/np.sum(mon.spec)
     down /= np.sum(mon.spec)
@@ -193,7 +254,7 @@ def run_int(run,name,mins=(0,0),maxs=(16,128),mask=None):
 def singleplot(run,name,mins=(0,0),maxs=(16,128)):
     data = spectrum(run,name,mins,maxs)
     data[np.isnan(data)]=0
-    plt.plot(np.arange(RESOLUTION)*20.0/RESOLUTION,data,"r-")
+    plt.plot(BINNING.lower(),data,"r-")
     plt.show()
 
 def echoplot(run,names,mins=(0,0),maxs=(16,128),mask=None,outfile=None):
@@ -296,7 +357,7 @@ def echodiff(run,names,split,mins,maxs,outfile=None):
 
     data[np.isnan(data)]=0
 
-    xs = np.arange(RESOLUTION)*20.0/RESOLUTION
+    xs = BINNING.lower()
     ys = np.array([float(x) for x in names])
     plt.pcolor(xs,ys,data,vmin=-np.pi,vmax=np.pi)
     if outfile is None:
@@ -307,54 +368,29 @@ def echodiff(run,names,split,mins,maxs,outfile=None):
         plt.clf()
 
 def two_flipper(runs, flipper1, flipper2, minmon, current, \
-                watch="2"):
+                watch="2", virtual=False, histogram=False, workers=1):
     
     data = load(runs,current)
+    write = writer(virtual,histogram)
     keys = data.keys()
-    values = [""]
     base = basedir + "SESAME_%i/" % runs[-1]
-
-    for value in values:
-        if type(value) is not str:
-            value = normalize_name(value)
-        upup = [x for x in keys if x[flipper1] < 0 and x[flipper2] < 0 \
-                and x[choices[watch]]==current]
-        updown = [x for x in keys if x[flipper1] < 0 and x[flipper2] > 0 \
-                  and x[choices[watch]]==current]
-        downup = [x for x in keys if x[flipper1] > 0 and x[flipper2] < 0 \
-                  and x[choices[watch]]==current]
-        downdown = [x for x in keys if x[flipper1] > 0 and x[flipper2] > 0 \
-                    and x[choices[watch]]==current]
-        if filter is not None:
-            value = "" #Don't put values on files when we're only running a single export
-
-        if upup != []:
-            print "-------------- Up/Up state --------------"
-            Combiner.save(base+value+"upup_current=" + str(current),
-                          minmon,
-                          upup,
-                          data)
-        if updown != []:
-            print "-------------- Up/Down state --------------"
-            Combiner.save(base+value+"updown_current=" + str(current),
-                          minmon,
-                          updown,
-                          data)
-        if downup != []:
-            print "-------------- Down/Up state --------------"
-            Combiner.save(base+value+"downup_current=" + str(current),
-                          minmon,
-                          downup,
-                          data)
-        if downdown != []:
-            print "-------------- Down/Down state --------------"
-            Combiner.save(base+value+"downdown_current=" + str(current),
-                          minmon,
-                          downdown,
-                          data)
-            
-        if [upup,updown,downup,downdown]==[[],[],[],[]]:
-            print("No data to write")
+    states = {(-1,-1):"upup",(-1,1):"updown",(1,-1):"downup",(1,1):"downdown"}
+
+    def classify(x):
+        if x[choices[watch]]!=current:
+            return None
+        return states.get((cmp(x[flipper1],0),cmp(x[flipper2],0)))
+    groups = partition(keys,classify)
+
+    jobs = []
+    for (state,label) in (("upup","Up/Up"),("updown","Up/Down"),
+                          ("downup","Down/Up"),("downdown","Down/Down")):
+        if state in groups:
+            jobs.append((label,base+state+"_current=" + str(current),
+                         minmon,groups[state]))
+    if jobs == []:
+        print("No data to write")
+    writeall(write,jobs,data,workers)
            
     
 
@@ -427,9 +463,33 @@ if __name__=='__main__':
     parser.add_option("--complex",action="store_true",
                      help="Whether to load the run data from runlist.txt")
 #
+    parser.add_option("--nocache",action="store_true",
+                      help="Histogram every file from its events instead "
+                      "of reusing cubes from the histogram cache")
+#
+    parser.add_option("--timing",action="store_true",
+                      help="Print where the time went in loading each file")
+#
+    parser.add_option("--virtual",action="store_true",
+                      help="Export dataset descriptors listing the runs "
+                      "instead of copying their events into new files")
+#
+    parser.add_option("--histogram",action="store_true",
+                      help="Export the summed cubes and monitor spectra "
+                      "of the runs instead of their events")
+#
+    parser.add_option("--workers",action="store",type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="Number of combinations to write at once")
+#
 
     (options,runs) = parser.parse_args()
 
+    if not options.nocache:
+        PelFile.cache = HistCache()
+    if options.timing:
+        PelFile.statsfunc = printstats
+
     if options.complex:
         runs = list(np.loadtxt("runlist.txt"))
     else:
@@ -442,10 +502,12 @@ if __name__=='__main__':
 
     if options.export=="flip":
         export(runs, choices[options.sortby], choices[options.flip], \
-               options.mon, options.current, options.filter, options.watch)
+               options.mon, options.current, options.filter, options.watch, \
+               options.virtual, options.histogram, options.workers)
     if options.export=="twoflip":
         two_flipper(runs, choices[options.flip], choices[options.flip2], \
-               options.mon, options.current, options.watch)
+               options.mon, options.current, options.watch, options.virtual, \
+               options.histogram, options.workers)
 #
 
     if options.mask is not None:
@@ -476,12 +538,12 @@ if __name__=='__main__':
                     count)]
             print(names)
             names = [name for name in names
-                     if os.path.exists(basedir+"SESAME_%i/" % runs[-1] + 
-                                       normalize_name(name)+
-                                       "up_neutron_event.dat") 
-                     and os.path.exists(basedir+"SESAME_%i/" % runs[-1] + 
-                                        normalize_name(name)+
-                                        "down_neutron_event.dat")]
+                     if os.path.exists(combined(runs[-1],
+                                                normalize_name(name)+"up",
+                                                "neutron_event.dat"))
+                     and os.path.exists(combined(runs[-1],
+                                                 normalize_name(name)+"down",
+                                                 "neutron_event.dat"))]
             print(names)
 #
 
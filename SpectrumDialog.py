@@ -10,8 +10,9 @@ automated rebinning of data.
 import wx
 import numpy as np
 from graphframe import GraphFrame
+from binning import DEFAULT as BINNING
 
-RESOLUTION = 400
+RESOLUTION = BINNING.resolution
 
 class SpectrumDialog(wx.Dialog):
     """A dialog to set the options on a spectrum plot"""
@@ -124,7 +125,7 @@ class SpectrumDialog(wx.Dialog):
         dtot=0 #counts in the down state
         #If there's no chosen error bounds, just return the original data.
         if self.nobinrad.GetValue():
-            return (np.arange(0.0,RESOLUTION)*20.0/RESOLUTION
+            return (BINNING.lower()
                     ,self.up,self.down)
     #
         #If we're going any sort of binning, we'll need raw values
@@ -145,7 +146,7 @@ class SpectrumDialog(wx.Dialog):
                     u.append(utot/self.uscale)
                     d.append(dtot/self.dscale)
                 #choose x as the center of the binned data
-                    x.append((i-0.5*count)*20.0/RESOLUTION)
+                    x.append(BINNING.wavelength(i-0.5*count))
                     i = 0
                     utot=0
                     dtot=0
@@ -159,7 +160,7 @@ class SpectrumDialog(wx.Dialog):
         elif self.setbinrad.GetValue():
             count = int(self.minerr.GetValue())
             x = [np.mean(y) for y in 
-                 np.array_split(np.arange(0.0,RESOLUTION)*20.0/RESOLUTION,count)]
+                 np.array_split(BINNING.lower(),count)]
             u = [np.sum(y)/self.uscale for y in np.array_split(up,count)]
             d = [np.sum(y)/self.dscale for y in np.array_split(down,count)]
             #print((x,u,d))
@@ -179,7 +180,7 @@ class SpectrumDialog(wx.Dialog):
     
         """
         if self.nobinrad.GetValue():
-            return (np.arange(0.0,RESOLUTION)*20.0/RESOLUTION,up/scale)
+            return (BINNING.lower(),up/scale)
     #
         elif self.autobinrad.GetValue():
             x=[]
@@ -193,7 +194,7 @@ class SpectrumDialog(wx.Dialog):
                 uerr = 1.0/np.sqrt(utot)
                 if uerr < emax:
                     u.append(utot/scale/(count+1))
-                    x.append((i-0.5*count)*20.0/RESOLUTION)
+                    x.append(BINNING.wavelength(i-0.5*count))
                     count = 0
                     utot=0
                 else:
@@ -202,7 +203,7 @@ class SpectrumDialog(wx.Dialog):
     #
         elif self.setbinrad.GetValue():
             count = int(self.minerr.GetValue())
-            x = np.arange(0.0,RESOLUTION)*20.0/RESOLUTION
+            x = BINNING.lower()
             x = np.array([np.mean(y) for y in np.array_split(x,count)])
             u = np.array([np.sum(y)/scale for y in np.array_split(up,count)])
             return (x,u)
@@ -25,7 +25,7 @@ if __name__=='__main__':
     data = [PelFile(basedir+"SESAME_%i/SESAME_%i_neutron_event.dat"%(r,r))
             for r in runs]
 
-    data = np.asarray([len(p.data)/2 for p in data])
+    data = np.asarray([p.reduce([("total",)])[0] for p in data])
 
     plt.title("Counts Versus Time")
     plt.xlabel("Run Number")
@@ -0,0 +1,136 @@
+"""Wavelength binning and instrument geometry
+
+This module contains a single class: Binning.  A Binning holds the edges
+of the wavelength bins used for histograms, along with the flight path
+that turns a raw time of flight into a neutron wavelength.  Every module
+which needs to know where the wavelength bins lie should share the
+Binning of the data it is handling, which is DEFAULT unless someone has
+asked for something else.
+
+The linear, logarithmic and custom functions build the common kinds of
+binning.
+
+"""
+
+import numpy as np
+
+class Binning:
+    """Wavelength bin edges and the flight path which maps TOF onto them"""
+    def __init__(self,edges,distanceToG4=3.7338+2.5297,
+                 distanceToDetector=3.835,timeOffset=860,linear=False):
+        """Create a Binning
+
+        Keyword arguments:
+        edges -- the increasing bin edges, in Angstroms
+        distanceToG4 -- flight path from the source to the end of G4
+        distanceToDetector -- flight path from the end of G4 to the detector
+        timeOffset -- microseconds between the pulse and the clock start
+        linear -- whether the edges are evenly spaced, which allows the
+                  bins to be found by scaling instead of searching
+
+        """
+        self.edges = np.asarray(edges,dtype=np.float64)
+        self.resolution = len(self.edges)-1
+        self.distanceToG4 = distanceToG4
+        self.distanceToDetector = distanceToDetector #FIXME
+        self.timeOffset = timeOffset
+        self.linear = linear
+        self.table = None #TOF to bin lookup, built when first needed
+
+    def fingerprint(self):
+        """Everything which decides the bin of an event"""
+        return (tuple(self.edges),self.distanceToG4,self.distanceToDetector,
+                self.timeOffset)
+
+    def angstroms(self):
+        """Angstroms of wavelength per microsecond of flight"""
+        return 3.956034e-7/(self.distanceToDetector+self.distanceToG4)/1e-10*1e-6
+
+    def convertTime(self,timearr):
+        """Convert an array of raw TOF data into neutron wavelengths in place"""
+        timearr *= 0.1 #Convert to microseconds
+        timearr -= self.timeOffset
+        timearr *= self.angstroms()
+        return timearr
+
+    def lower(self):
+        """The wavelength at the start of each bin"""
+        return self.edges[:-1]
+
+    def wavelength(self,position):
+        """The wavelength at a (possibly fractional) bin position"""
+        return np.interp(position,np.arange(self.resolution+1),self.edges)
+
+    def index(self,wavelength):
+        """The bin holding a wavelength, clipped to the binning"""
+        i = np.searchsorted(self.edges,wavelength,side="right")-1
+        return int(min(max(i,0),self.resolution))
+
+    def lookup(self):
+        """The table which maps raw TOF onto bins
+
+        Entry t+1 holds the bin of an event with raw TOF t, or -1 if
+        the event lies outside of the binning.  The first and last
+        entries are -1 so that clipped TOFs fall outside of the bins.
+
+        """
+        if self.table is not None:
+            return self.table
+        #The last raw TOF which can fall inside the last bin
+        top = int(np.ceil((self.edges[-1]/self.angstroms()+
+                           self.timeOffset)*10))+1
+        tof = np.arange(top+1,dtype=np.float64)
+        if self.linear:
+            #Scale onto the bins with the same arithmetic as the old
+            #convertTime, so the bins match it exactly
+            scale = self.resolution/(self.edges[-1]-self.edges[0])
+            tof *= 0.1
+            tof -= self.timeOffset
+            tof *= self.angstroms()*scale
+            tof -= self.edges[0]*scale
+            bins = np.floor(tof)
+        else:
+            bins = np.searchsorted(self.edges,self.convertTime(tof),
+                                   side="right")-1
+        bins[np.logical_or(bins < 0,bins >= self.resolution)] = -1
+        self.table = np.empty(top+3,dtype=np.int32)
+        self.table[1:-1] = bins
+        self.table[0] = -1
+        self.table[-1] = -1
+        return self.table
+
+    def bins(self,tof):
+        """Find the bin of each raw TOF, with -1 for those outside"""
+        table = self.lookup()
+        tof = np.clip(tof,-1,len(table)-2)
+        tof += 1
+        return table[tof]
+
+    def tofrange(self,first,last):
+        """The raw TOFs, as a half open range, in bins first to last-1"""
+        table = self.lookup()[1:-1]
+        hits = np.nonzero(np.logical_and(table >= first,table < last))[0]
+        if len(hits) == 0:
+            return (0,0)
+        return (int(hits[0]),int(hits[-1])+1)
+
+    def __getstate__(self):
+        """Leave the lookup table out when pickling, as it is rebuilt quickly"""
+        state = dict(self.__dict__)
+        state["table"] = None
+        return state
+
+def linear(lmin=0.0,lmax=20.0,count=400,**geometry):
+    """Evenly spaced bins from lmin to lmax Angstroms"""
+    return Binning(np.linspace(lmin,lmax,count+1),linear=True,**geometry)
+
+def logarithmic(lmin,lmax,count,**geometry):
+    """Bins evenly spaced in log wavelength from lmin to lmax Angstroms"""
+    return Binning(np.logspace(np.log10(lmin),np.log10(lmax),count+1),
+                   **geometry)
+
+def custom(edges,**geometry):
+    """Bins with arbitrary increasing edges in Angstroms"""
+    return Binning(edges,**geometry)
+
+DEFAULT = linear() #Twenty Angstroms in steps of 0.05 Angstroms
@@ -1,58 +1,47 @@
 import reader
+from histcache import HistCache
+import runcatalog
 import numpy as np
-import xml.etree.ElementTree as ET
-from datetime import datetime
+from datetime import datetime, timedelta
 from matplotlib import pyplot as plt
 
 base_dir = "C:/userfiles/EXP011/SESAME_%i/SESAME_%i_"
-XMLNS = "{http://neutrons.ornl.gov/SNS/DAS/runinfo_v4_3}"
 
 def get_file(run):
+    """The detector image and tube totals of a run, from one pass"""
     pel = reader.PelFile(base_dir%(run,run) + "neutron_event.dat")
-    return pel.make3d()
+    return pel.reduce([("image",0,pel.binning.resolution),("tubes",)])
 
 
-def get_centroid(cube):
-    height = np.sum(np.sum(cube,axis=1),axis=1)
+def get_centroid(image):
+    height = np.sum(image,axis=1)
     return np.sum(height*np.arange(128))/np.sum(height)
 
-def get_dead(cube):
-    all = np.sum(cube,axis=2)
-    return(np.sum(all[:,[4,6]]))
+def get_dead(tubes):
+    return(np.sum(tubes[[4,6]]))
 
-def get_live(cube):
-    all = np.sum(cube,axis=2)
-    return(np.sum(all[:,[5,7]]))
+def get_live(tubes):
+    return(np.sum(tubes[[5,7]]))
 
 def get_time(run):
-    data_file = base_dir%(run,run) + "runinfo.xml"
-    root = ET.parse(data_file).getroot()
-    start = root.find(".//"+XMLNS+"StartTime").text.strip()
-    stop = root.find(".//"+XMLNS+"StopTime").text.strip()
-
-    format = "%Y-%m-%dT%H:%M:%S-04:00"
-    start = datetime.strptime(start,format)
-    stop = datetime.strptime(stop,format)
-
-    return (stop,stop-start)
+    info = runcatalog.shared().run(base_dir%(run,run) + "runinfo.xml")
+    stop = datetime.fromtimestamp(info.stop)
+    return (stop,timedelta(seconds=info.duration))
 
 def get_monitor(run):
-    mon_file = base_dir%(run,run) + "bmon_histo.dat"
-    return np.sum(np.fromfile(mon_file,np.int32,-1))
+    return runcatalog.shared().run(base_dir%(run,run) + "runinfo.xml").monitor
 
 def get_info(run):
-    cube = get_file(run)
+    image,tubes = get_file(run)
 
-    cen = get_centroid(cube)
+    cen = get_centroid(image)
 
     mon = get_monitor(run)
-    intensity = np.sum(cube)/mon
-    dead = get_dead(cube)/mon
-    live = get_live(cube)/mon
+    intensity = np.sum(image)/mon
+    dead = get_dead(tubes)/mon
+    live = get_live(tubes)/mon
 
     end,length = get_time(run)
-    
-    del cube
 
     return (intensity,cen,mon,dead,live,end,length)
 
@@ -100,6 +89,7 @@ def view(start,stop):
 
 
 if __name__ == "__main__":
+    reader.PelFile.cache = HistCache()
 #    save(67,274)
     view(67,274)
 
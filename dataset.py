@@ -0,0 +1,148 @@
+"""Virtual combined datasets
+
+A combined dataset stands in for the event and monitor files which
+Combiner.save writes, without copying any events.  It's a small JSON
+descriptor listing every run that was considered for the combination,
+with the run's event and monitor files, its time and counts, and
+whether it was included or why it was rejected.  PelFile and MonFile
+open a descriptor as if it were a single file, reading the events and
+monitor spectra of the included runs as they are needed.
+
+Descriptors are named for the files they stand in for, so the dataset
+which Combiner.save would write as NAME_neutron_event.dat and
+NAME_bmon_histo.dat is described in NAME + SUFFIX.
+
+A combined cube, in NAME + CUBESUFFIX, goes one step further and keeps
+only the summed cube and monitor spectrum of the included runs, along
+with the run list and the binning and tube map of the cube.  PelFile
+and MonFile open it too, though it has no events to reduce.
+
+"""
+
+import json
+import os
+import os.path
+
+import numpy as np
+
+import binning as binnings
+from histcache import replace
+
+SUFFIX = "_combined.json"
+CUBESUFFIX = "_combined.npz"
+FORMAT = 1 #Version of the descriptor layout
+MONITORBINS = 50001 #Length of a monitor spectrum
+
+def isdataset(path):
+    """Whether a path names a dataset descriptor"""
+    return path.endswith(SUFFIX)
+
+def iscube(path):
+    """Whether a path names a combined cube"""
+    return path.endswith(CUBESUFFIX)
+
+def write(path,runs,**settings):
+    """Write a descriptor
+
+    Keyword arguments:
+    path -- the descriptor file
+    runs -- a list of dictionaries, one for each run, holding at least
+            the run's "events" and "monitor" paths and whether it is
+            "included"
+    settings -- anything else worth recording, such as the monitor
+                rate cut the runs were chosen with
+
+    """
+    descriptor = dict(settings)
+    descriptor["format"] = FORMAT
+    descriptor["runs"] = runs
+    temp = path+".tmp"
+    with open(temp,"w") as stream:
+        json.dump(descriptor,stream,indent=1,sort_keys=True)
+    replace(temp,path)
+
+def read(path):
+    """Read a descriptor, with member paths made relative to it absolute"""
+    with open(path,"r") as stream:
+        descriptor = json.load(stream)
+    if descriptor.get("format") != FORMAT:
+        raise ValueError(path + " is not a combined dataset descriptor")
+    base = os.path.dirname(os.path.abspath(path))
+    for run in descriptor["runs"]:
+        for key in ("events","monitor"):
+            run[key] = os.path.join(base,run[key])
+    return descriptor
+
+def included(path):
+    """The runs of a dataset which were included in it"""
+    return [run for run in read(path)["runs"] if run["included"]]
+
+def eventfiles(path):
+    """The event files of the runs included in a dataset"""
+    return [run["events"] for run in included(path)]
+
+def monitorfiles(path):
+    """The monitor files of the runs included in a dataset"""
+    return [run["monitor"] for run in included(path)]
+
+def writecube(path,cube,mon,runs,binning,tubemap,**settings):
+    """Write a combined cube
+
+    Keyword arguments:
+    path -- the combined cube file
+    cube -- the summed cube of the included runs
+    mon -- the summed monitor spectrum of the included runs
+    runs -- a list of dictionaries, one for each run, as for write
+    binning -- the Binning of the cube
+    tubemap -- the name of the tube map of the cube
+    settings -- anything else worth recording
+
+    """
+    descriptor = dict(settings)
+    descriptor["format"] = FORMAT
+    descriptor["runs"] = runs
+    temp = path[:-4]+".tmp.npz"
+    np.savez_compressed(temp,cube=np.asarray(cube,np.float32),
+                        monitor=np.asarray(mon,np.int32),
+                        edges=binning.edges,
+                        distanceToG4=np.array(binning.distanceToG4),
+                        distanceToDetector=np.array(binning.distanceToDetector),
+                        timeOffset=np.array(binning.timeOffset),
+                        tubemap=np.array(tubemap),
+                        descriptor=np.array(json.dumps(descriptor)))
+    replace(temp,path)
+
+def readcube(path):
+    """Read a cube archive, returning the cube, Binning and tube map name
+
+    Both combined cubes and the per-file archives of histbatch, which
+    keep the name of their tube map in tubemapname, can be read.
+
+    """
+    with np.load(path) as saved:
+        if "cube" not in saved.files or "edges" not in saved.files:
+            raise ValueError(path + " is not a cube archive")
+        geometry = binnings.Binning(saved["edges"],
+                                    float(saved["distanceToG4"]),
+                                    float(saved["distanceToDetector"]),
+                                    float(saved["timeOffset"]))
+        if "tubemapname" in saved.files:
+            tubemap = str(saved["tubemapname"])
+        else:
+            tubemap = str(saved["tubemap"])
+        return (saved["cube"],geometry,tubemap)
+
+def readruns(path):
+    """The runs recorded in a combined cube"""
+    with np.load(path) as saved:
+        return json.loads(str(saved["descriptor"]))["runs"]
+
+def monitor(path):
+    """The summed monitor spectrum of the runs included in a dataset"""
+    if iscube(path):
+        with np.load(path) as saved:
+            return saved["monitor"]
+    spec = np.zeros((MONITORBINS,),dtype=np.int32)
+    for monpath in monitorfiles(path):
+        spec += np.fromfile(monpath,dtype=np.int32)
+    return spec
@@ -0,0 +1,23 @@
+"""Convert event files into pixel sorted event indices
+
+Usage: python eventindex.py pattern [pattern ...]
+
+Each neutron_event.dat file matching the glob patterns is rewritten
+as a .idx file next to it.  PelFile can open the index like an event
+file, and answers region and wavelength band counts from it by binary
+search instead of scanning every event.
+
+"""
+
+import __future__
+import glob
+import sys
+
+from reader import writeindex
+
+if __name__=="__main__":
+    files = [x for pattern in sys.argv[1:] for x in glob.glob(pattern)]
+    files = [x for x in files if x[-4:]==".dat"]
+    for file in files:
+        writeindex(file,file[:-4]+".idx")
+        print(file)
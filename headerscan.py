@@ -0,0 +1,65 @@
+"""Catalog the headers of many PEL files without reading their events
+
+Usage: python headerscan.py output.npy pattern [pattern ...]
+
+Only the 256 byte header of each file matching the glob patterns is
+read.  The PMT gains, supply voltages, temperatures and timestamps are
+collected into a numpy structured array, one row per file, which is
+saved to the output file for gain history studies.
+
+"""
+
+import __future__
+import calendar
+import glob
+import sys
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from reader import PelFile
+
+#One row of the header catalog
+HEADERTABLE = np.dtype([("path","U260"),
+                        ("time",np.int64), #Seconds since the epoch
+                        ("gains",np.uint16,(20,)), #x1-x10 then y1-y10
+                        ("papa",np.uint16), #PMT supply voltage command
+                        ("energy",np.uint16), #Energy PMT supply voltage command
+                        ("mcp",np.uint16), #MCP supply voltage command
+                        ("temperatures",np.uint16,(2,)),
+                        ("setpoints",np.uint16,(2,))])
+
+def headertime(h):
+    """The time stamp of a header, or zero if it isn't a real date"""
+    try:
+        return calendar.timegm((h.Year,h.Month,h.Day,h.Hour,h.Minute,
+                                h.Second,0,0,0))
+    except (ValueError,OverflowError):
+        return 0
+
+def headerrow(path):
+    """Read the header of one file into a row of the catalog"""
+    pel = PelFile()
+    h = pel.peakheader(path)
+    return (path,headertime(h),pel.getgains(h),
+            h.PAPAPowerSupplyVoltageCommand,
+            h.EnergyPowerSupplyVoltageCommand,
+            h.MCPPowerSupplyVoltageCommand,
+            (h.Temperature1,h.Temperature2),
+            (h.TemperatureSetPoint1,h.TemperatureSetPoint2))
+
+def scan(paths,threads=8):
+    """Catalog the headers of paths, reading several files at once"""
+    pool = ThreadPool(threads)
+    try:
+        rows = pool.map(headerrow,paths)
+    finally:
+        pool.close()
+        pool.join()
+    return np.array(rows,dtype=HEADERTABLE)
+
+if __name__=="__main__":
+    files = sorted([x for pattern in sys.argv[2:] for x in glob.glob(pattern)])
+    table = scan(files)
+    np.save(sys.argv[1],table)
+    print("Cataloged %i headers" % len(table))
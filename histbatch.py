@@ -1,14 +1,114 @@
+"""Histogram a whole set of event files into cube archives
+
+Usage: python histbatch.py [--workers N] [--force] pattern [pattern ...]
+
+Every event file matching the glob patterns is made into a cube, which
+is saved next to it as a compressed .npz archive holding the cube, the
+wavelength binning and tube map which made it, and the size and time
+stamp of the event file.  Files are histogrammed in a pool of worker
+processes, and a file whose archive was made from the same data with
+the same settings is skipped, so rerunning over an experiment only
+counts what is new.  PelFile, and so PELvis, opens the archives as it
+does the event files they were made from.
+
+"""
+
 import __future__
-from reader import PelFile
 import glob
+import multiprocessing
+import os
+from optparse import OptionParser
+from timeit import default_timer
+
 import numpy as np
-import sys
-
-files = glob.glob(sys.argv[1])
-print(files)
-files = [x for x in files if x[-3:]=="pel"]
-for file in files:
-    data = PelFile(file)
-    hist = data.make3d()
-    np.save(file+".npy",hist)
-    print(file)
+
+from histcache import replace
+from reader import PelFile, TUBEMAPS
+
+def outputpath(path):
+    """The archive made from an event file"""
+    return os.path.splitext(path)[0]+".npz"
+
+def describe(pel):
+    """The metadata saved alongside the cube of a PelFile"""
+    stat = os.stat(pel.path)
+    geometry = pel.binning
+    return {"source":np.array(os.path.abspath(pel.path)),
+            "size":np.array(stat.st_size,dtype=np.int64),
+            "mtime":np.array(stat.st_mtime),
+            "edges":geometry.edges,
+            "distanceToG4":np.array(geometry.distanceToG4),
+            "distanceToDetector":np.array(geometry.distanceToDetector),
+            "timeOffset":np.array(geometry.timeOffset),
+            "tubemapname":np.array(pel.tubemap),
+            "tubemap":np.array(TUBEMAPS[pel.tubemap],dtype=np.int32)}
+
+def uptodate(path,metadata):
+    """Whether the archive at path was made with exactly this metadata"""
+    try:
+        with np.load(path) as archive:
+            return all(name in archive.files and
+                       np.array_equal(archive[name],value)
+                       for (name,value) in metadata.items())
+    except (IOError,OSError,ValueError):
+        return False
+
+def convert(task):
+    """Histogram one event file into its archive
+
+    Returns the path, whether it was histogrammed rather than found
+    up to date, the number of events counted, the bytes read and the
+    time taken.
+
+    """
+    path,force = task
+    start = default_timer()
+    pel = PelFile(path)
+    output = outputpath(path)
+    metadata = describe(pel)
+    if not force and uptodate(output,metadata):
+        return (path,False,0,0,default_timer()-start)
+    cube = pel.make3d()
+    temp = output[:-4]+".tmp.npz"
+    np.savez_compressed(temp,cube=cube,**metadata)
+    replace(temp,output)
+    return (path,True,pel.stats.events,pel.stats.bytes,default_timer()-start)
+
+def convertall(files,workers,force=False):
+    """Histogram every file in a pool of workers and print a summary"""
+    start = default_timer()
+    converted = skipped = events = size = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        for (path,made,count,read,elapsed) in pool.imap_unordered(
+                convert,[(f,force) for f in files]):
+            if not made:
+                skipped += 1
+                print("%s: up to date" % path)
+            else:
+                converted += 1
+                events += count
+                size += read
+                print("%s: %i events in %.3f s" % (path,count,elapsed))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = default_timer()-start
+    print("Converted %i files and skipped %i in %.1f s" %
+          (converted,skipped,elapsed))
+    if elapsed > 0:
+        print("%i events, %.1f MB: %.3g events/s, %.1f MB/s" %
+              (events,size/2.0**20,events/elapsed,size/2.0**20/elapsed))
+
+if __name__=="__main__":
+    parser = OptionParser(usage="histbatch.py [options] pattern [pattern ...]")
+    parser.add_option("--workers",action="store",type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="Number of files to histogram at once")
+    parser.add_option("--force",action="store_true",
+                      help="Histogram every file, even if its archive is "
+                      "up to date")
+    (options,patterns) = parser.parse_args()
+    files = sorted(set([x for pattern in patterns for x in glob.glob(pattern)]))
+    files = [x for x in files if x[-4:] in (".dat",".pel",".idx")]
+    convertall(files,options.workers,options.force)
@@ -0,0 +1,294 @@
+"""Compare the speed of the histogram engines in reader.
+
+Builds a synthetic event list, histograms it with the original
+wavelength-by-wavelength loop and with PelFile.make3d, checks that
+the two cubes are identical and prints the time each one took.
+
+With --workers, a synthetic event file is written instead and
+make3d is timed with each of the given numbers of worker processes.
+
+With --suite, realistic event files of each given size are generated
+and readfileimage, make3d, make1d and spectrum are timed on them,
+along with the peak memory each one allocates.  The results are saved
+as JSON so that runs on different versions can be compared.  Where
+tracemalloc is missing, as on Python 2, the peak resident size of the
+process is recorded instead.
+
+--generate writes a realistic event file to keep.
+
+Usage: python histbench.py [events] [--workers 1,2,4,8]
+       python histbench.py --suite 1e5,1e6,1e7 [--output bench.json]
+       python histbench.py [events] --generate path_neutron_event.dat
+
+"""
+
+import __future__
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from timeit import default_timer
+
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:
+    #Python 2 can't trace allocations, so the peak RSS is used instead
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    #Windows has no getrusage, so only times are reported there
+    resource = None
+
+import binning
+from reader import PelFile, RESOLUTION, TUBEMAPS, TUBEMAP, pixelmap
+
+def synthetic(events,seed=0):
+    """Make an int32 (time,position) array of random events"""
+    rand = np.random.RandomState(seed)
+    data = np.empty(2*events,dtype=np.int32)
+    #Raw times in 0.1us steps spanning a little more than 0-20 Angstroms
+    data[0::2] = rand.randint(0,550000,events)
+    data[1::2] = rand.randint(0,8*256,events)
+    return data
+
+def writesynthetic(path,events,chunk=10**7):
+    """Write a synthetic event file a piece at a time"""
+    with open(path,"wb") as outfile:
+        for i,start in enumerate(range(0,events,chunk)):
+            synthetic(min(chunk,events-start),seed=i).tofile(outfile)
+
+DEADTUBES = [4,6] #Image columns which see no neutrons in realistic data
+
+def realistic(events,seed=0,dead=DEADTUBES):
+    """Make an int32 (time,position) array of lifelike events
+
+    Wavelengths follow a moderator-like spectrum peaking near 3.5
+    Angstroms.  Nine in ten events fall in a beam spot on the middle
+    of the detector and the rest are spread evenly, except that the
+    dead tubes record nothing.  Events which would land on a dead tube
+    are drawn again, so exactly the given number of events is made.
+
+    """
+    rand = np.random.RandomState(seed)
+    wavelength = rand.gamma(4.0,1.0,events)+0.5
+    geometry = binning.DEFAULT
+    tof = (wavelength/geometry.angstroms()+geometry.timeOffset)*10
+    deadtube = np.zeros(16,dtype=bool)
+    deadtube[list(dead)] = True
+    xs = []
+    ys = []
+    found = 0
+    while found < events:
+        wanted = events-found
+        y = np.where(rand.rand(wanted) < 0.9,rand.normal(64,15,wanted),
+                     rand.uniform(0,128,wanted))
+        x = np.where(rand.rand(wanted) < 0.9,rand.normal(8,3,wanted),
+                     rand.uniform(0,16,wanted))
+        y = np.clip(y,0,127).astype(np.intp)
+        x = np.clip(x,0,15).astype(np.intp)
+        live = np.logical_not(deadtube[x])
+        xs.append(x[live])
+        ys.append(y[live])
+        found += int(np.sum(live))
+    x = np.concatenate(xs+[np.zeros(0,np.intp)])
+    y = np.concatenate(ys+[np.zeros(0,np.intp)])
+    #Turn detector pixels back into the raw positions which map to them
+    raw = np.argsort(pixelmap())
+    data = np.empty((events,2),dtype=np.int32)
+    data[:,0] = tof
+    data[:,1] = raw[16*y+x]
+    return data.ravel()
+
+def generate(path,events,chunk=10**7,dead=DEADTUBES):
+    """Write a realistic event file with the given number of events
+
+    The file is written a chunk at a time, so any size can be made.
+
+    """
+    with open(path,"wb") as outfile:
+        for i,start in enumerate(range(0,events,chunk)):
+            realistic(min(chunk,events-start),seed=i,dead=dead).tofile(outfile)
+
+def loop_mapim(imarray,maparray=TUBEMAPS[TUBEMAP]):
+    """The original mapim, which moves the pixels one at a time"""
+    newimarray=np.zeros((128,16))
+    for i in range(len(maparray)):
+        ti=maparray[i]
+        if 0.5*ti!=int(0.5*ti):
+            for j in range(128):
+                newimarray[j,i]=imarray[127-j,(ti-1)//2]
+        else:
+            for j in range(128):
+                newimarray[j,i]=imarray[128+j,ti//2-1]
+    return newimarray
+
+def loop_make3d(pel):
+    """The original make3d, which loops over the wavelength bins"""
+    cube = np.zeros([128,16,RESOLUTION],dtype=np.float32)
+    if len(pel.data)==0:
+        return cube
+    Z = pel.data[1::2] & 0xFFFF#position data
+    timearr = pel.convertTime(np.asarray(pel.data[0::2], \
+                                         dtype=np.float64))#time data
+    timearr = np.asarray(np.floor(timearr),np.uint16)
+    for i in range(RESOLUTION):
+        place = np.where(timearr==i)
+        if len(place[0]) > 0:
+            temp,_ = np.histogram(Z[place],bins = np.arange(8*256+1))
+            temp = temp.reshape(256,8,order="F")
+            cube[:,:,i] = loop_mapim(temp)[::-1,:]
+    return cube
+
+def timed(f,*args):
+    """Call f and return its result with the elapsed time"""
+    start = default_timer()
+    result = f(*args)
+    return result,default_timer()-start
+
+def peakrss():
+    """The peak resident size of this process in bytes, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak #Already in bytes
+    return peak*1024
+
+def memory():
+    """How measured finds the peak memory of a stage"""
+    if tracemalloc is not None:
+        return "tracemalloc"
+    if resource is not None:
+        return "rss"
+    return None
+
+def measured(f,*args):
+    """Call f and return its elapsed time and peak memory in bytes
+
+    With tracemalloc the peak is what f itself allocates, which leaves
+    out the pages of memory mapped files.  Without it, the peak is the
+    high-water resident size of the whole process after f, which does
+    count the mapped pages f touched, but also anything before it.
+
+    """
+    if tracemalloc is None:
+        _,elapsed = timed(f,*args)
+        return elapsed,peakrss()
+    tracemalloc.start()
+    try:
+        _,elapsed = timed(f,*args)
+        _,peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed,peak
+
+def benchmark(path):
+    """Time and measure each stage of the reader on an event file"""
+    stages = {}
+    pel = PelFile()
+    stages["readfileimage"] = measured(pel.readfileimage,path)
+    stages["make3d"] = measured(pel.make3d)
+    stages["make1d"] = measured(pel.make1d,(0,0),(16,128))
+    spectrum = tempfile.mktemp(suffix=".txt")
+    try:
+        stages["spectrum"] = measured(pel.spectrum,spectrum)
+    finally:
+        if os.path.exists(spectrum):
+            os.remove(spectrum)
+    del pel
+    return dict([(name,{"seconds":elapsed,"peak":peak})
+                 for (name,(elapsed,peak)) in stages.items()])
+
+def suite(sizes,output=None):
+    """Benchmark the reader on realistic files of each size"""
+    results = {"date":time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python":platform.python_version(),
+               "numpy":np.__version__,
+               "machine":platform.machine(),
+               "memory":memory(),
+               "runs":[]}
+    for events in sizes:
+        handle,path = tempfile.mkstemp(suffix="_neutron_event.dat")
+        os.close(handle)
+        try:
+            generate(path,events)
+            size = os.path.getsize(path)
+            run = {"events":size//8,"bytes":size,"stages":benchmark(path)}
+        finally:
+            os.remove(path)
+        results["runs"].append(run)
+        print("Events: %i" % run["events"])
+        for name in ["readfileimage","make3d","make1d","spectrum"]:
+            stage = run["stages"][name]
+            if stage["peak"] is None:
+                print("  %-14s %9.3f s" % (name,stage["seconds"]))
+            else:
+                print("  %-14s %9.3f s %9.1f MB" %
+                      (name,stage["seconds"],stage["peak"]/2.0**20))
+    if output is not None:
+        with open(output,"w") as stream:
+            json.dump(results,stream,indent=2)
+    return results
+
+def compare(events):
+    """Time the original loop against make3d"""
+    pel = PelFile()
+    pel.data = synthetic(events)
+    old,oldtime = timed(loop_make3d,pel)
+    new,newtime = timed(pel.make3d)
+    print("Events: %i" % events)
+    print("Loop:     %8.3f s" % oldtime)
+    print("Bincount: %8.3f s" % newtime)
+    print("Speedup:  %8.1fx" % (oldtime/newtime))
+    print("Identical: %s" % np.array_equal(old,new))
+
+def scaling(events,workers):
+    """Time make3d on a synthetic file with each number of workers"""
+    handle,path = tempfile.mkstemp(suffix="_neutron_event.dat")
+    os.close(handle)
+    try:
+        writesynthetic(path,events)
+        pel = PelFile(path)
+        print("Events: %i" % events)
+        serial = None
+        for count in workers:
+            pel.workers = count
+            cube,elapsed = timed(pel.make3d)
+            if serial is None:
+                serial,base = cube,elapsed
+            print("Workers: %2i %8.3f s %6.2fx Identical: %s" %
+                  (count,elapsed,base/elapsed,np.array_equal(serial,cube)))
+        del pel
+    finally:
+        os.remove(path)
+
+if __name__=="__main__":
+    parser = OptionParser(usage="histbench.py [events]")
+    parser.add_option("--workers",action="store",type="string",default=None,
+                      help="Comma separated worker counts to time make3d "
+                      "with on a synthetic file, such as 1,2,4,8")
+    parser.add_option("--suite",action="store",type="string",default=None,
+                      help="Comma separated event counts to benchmark the "
+                      "reader stages with, such as 1e5,1e6,1e7")
+    parser.add_option("--output",action="store",type="string",default=None,
+                      help="A JSON file in which to save the suite results")
+    parser.add_option("--generate",action="store",type="string",default=None,
+                      help="Write a realistic event file to this path")
+    (options,args) = parser.parse_args()
+    if args:
+        events = int(float(args[0]))
+    else:
+        events = 10**6
+    if options.generate is not None:
+        generate(options.generate,events)
+    elif options.suite is not None:
+        suite([int(float(x)) for x in options.suite.split(",")],options.output)
+    elif options.workers is None:
+        compare(events)
+    else:
+        scaling(events,[int(x) for x in options.workers.split(",")])
@@ -0,0 +1,140 @@
+"""A disk cache for histograms made from event files
+
+This module contains a single class: HistCache.  Event files are never
+changed once a run is finished, so the cube made from one only needs to
+be counted once.  A HistCache keeps those cubes as .npy files in a
+directory, named for a hash of the PelFile fingerprint which made them,
+and throws out the least recently used cubes when the directory grows
+past its size limit.  Other state worth keeping between runs, such as
+the running counts of a file which is still being written, can be kept
+with savestate.
+
+"""
+
+import hashlib
+import os
+import os.path
+import tempfile
+
+import numpy as np
+
+CACHEDIR = os.path.join(os.path.expanduser("~"),".pelvis","cache")
+MAXBYTES = 2*2**30 #Two gigabytes, or about six hundred cubes
+
+def replace(temp,path):
+    """Move a finished file from temp to path, replacing any file there
+
+    Files are written to a temporary name and moved into place, so a
+    reader never sees one half written.  On POSIX the rename replaces
+    the old file atomically, but Windows won't rename over an existing
+    file, so there the old one is removed first.
+
+    """
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp,path)
+
+def mktemp(directory,suffix):
+    """Make an empty temporary file in directory, unique to this writer"""
+    handle,temp = tempfile.mkstemp(suffix=suffix,dir=directory)
+    os.close(handle)
+    return temp
+
+class HistCache:
+    """A directory of histogram cubes, evicted least recently used first"""
+    def __init__(self,directory=CACHEDIR,maxbytes=MAXBYTES):
+        """Create a cache in directory holding at most maxbytes of cubes"""
+        self.directory = directory
+        self.maxbytes = maxbytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self,fingerprint):
+        """The file which holds the cube for a fingerprint"""
+        key = hashlib.sha1(repr(fingerprint).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory,key+".npy")
+
+    def load(self,fingerprint):
+        """Return the cached cube for a fingerprint, or None"""
+        path = self.path(fingerprint)
+        try:
+            cube = np.load(path)
+        except (IOError,OSError,ValueError):
+            return None
+        try:
+            os.utime(path,None) #Mark the cube as recently used
+        except OSError:
+            pass #Evicted by another loader since it was read
+        return cube
+
+    def save(self,fingerprint,cube):
+        """Store the cube for a fingerprint and trim the cache"""
+        path = self.path(fingerprint)
+        self.store(path,".tmp.npy",lambda temp: np.save(temp,cube))
+
+    def store(self,path,suffix,write):
+        """Write a cache file through a temporary file of its own
+
+        Several loaders may store the same key at once, so each writes
+        its own temporary file.  If the file can't be put in place, the
+        entry is simply left out of the cache, as a cache miss.
+
+        """
+        temp = mktemp(self.directory,suffix)
+        try:
+            write(temp)
+            replace(temp,path)
+        except (IOError,OSError):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+        self.evict()
+
+    def loadstate(self,key):
+        """Return the arrays saved for a key by savestate, or None"""
+        path = self.path(key)[:-4]+".npz"
+        try:
+            with np.load(path) as saved:
+                state = dict((name,saved[name]) for name in saved.files)
+        except (IOError,OSError,ValueError):
+            return None
+        try:
+            os.utime(path,None)
+        except OSError:
+            pass
+        return state
+
+    def savestate(self,key,**arrays):
+        """Store named arrays for a key, replacing any already saved"""
+        path = self.path(key)[:-4]+".npz"
+        self.store(path,".tmp.npz",lambda temp: np.savez(temp,**arrays))
+
+    def dropstate(self,key):
+        """Forget the arrays saved for a key by savestate"""
+        try:
+            os.remove(self.path(key)[:-4]+".npz")
+        except OSError:
+            pass #Never saved, or evicted already
+
+    def evict(self):
+        """Remove the least recently used files until under maxbytes"""
+        paths = [os.path.join(self.directory,name)
+                 for name in os.listdir(self.directory)
+                 if name[-4:] in (".npy",".npz") and ".tmp." not in name]
+        files = []
+        for p in paths:
+            try:
+                files.append((os.path.getmtime(p),os.path.getsize(p),p))
+            except OSError:
+                pass #Evicted by another loader in the meantime
+        files.sort()
+        total = sum([size for (_,size,_) in files])
+        for (_,size,path) in files:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
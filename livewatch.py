@@ -2,17 +2,15 @@ import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib as mpl
 import time
-from reader import PelFile
+from reader import PelFile, printstats
+from histcache import HistCache
 from monfile import MonFile
 import sys
 import os.path
-import xml.etree.ElementTree as ET
-import HTMLParser
-import json
+import runcatalog
 
 RUN = 32725
 basedir = "C:/userfiles/EXP011/"
-XMLNS = "{http://neutrons.ornl.gov/SNS/DAS/runinfo_v4_3}"
 REBIN = 4
 
 plt.ion()
@@ -23,19 +21,30 @@ def spectrum(run,mins=(0,0),maxs=(16,128),mask=None):
         return None
     p = PelFile(eventfile)
     mon = MonFile(basedir+"SESAME_%i/SESAME_%i" % (run,run) +"_bmon_histo.dat",False)
-    up = p.make1d(mins,maxs,mask)
+    #The run is finished, so only the events written since it was last
+    #followed are read, and its cube is cached for good
+    up = np.sum(p.update(True)[p.roimask(mins,maxs,mask)],axis=0,dtype=np.float64)
 
     manifestFile = basedir+"SESAME_%i/SESAME_%i" % (run,run) + "_runinfo.xml"
-
-    text = ET.parse(manifestFile).getroot().find(".//"+XMLNS+"Notes").text
-    text = HTMLParser.HTMLParser().unescape(text)
-    manifest = json.loads(text)
+    manifest = runcatalog.shared().run(manifestFile).manifest
 
     return up,np.sum(mon.spec),manifest
 
 
 mpl.rcParams['interactive'] = True
 
+def follow(run):
+    """Count the events of a run in progress as they are written
+
+    The running counts are kept in the histogram cache, so each call,
+    and the spectrum of the run once it finishes, only reads the events
+    written since the last one.
+
+    """
+    eventfile = basedir+"SESAME_%i/SESAME_%i" % (run,run) + "_neutron_event.dat"
+    if os.path.isfile(eventfile):
+        PelFile(eventfile).update()
+
 def manifestly(start):
     i = start
     while True:
@@ -44,18 +53,16 @@ def manifestly(start):
         if not os.path.isfile(monitorFile):
             #If the monitor file hasn't been written, the run isn't
             #done yet and we shouldnt' read it
+            follow(i)
             yield None
         else:
-            try:
-                manifestFile = basedir+"SESAME_%i/SESAME_%i" % (i,i) + "_runinfo.xml"
-
-                text = ET.parse(manifestFile).getroot().find(".//"+XMLNS+"Notes").text
-                text = HTMLParser.HTMLParser().unescape(text)
-                manifest = json.loads(text)
-                yield i,manifest
-                i += 1
-            except ValueError:
+            info = runcatalog.shared().run(manifestFile)
+            if info is None or info.manifest is None:
+                #The run info may not be completely written yet
                 yield None
+            else:
+                yield i,info.manifest
+                i += 1
 
 
 
@@ -140,6 +147,9 @@ def rebin(x,bins):
 
 if __name__=="__main__":
 
+    PelFile.cache = HistCache()
+    PelFile.statsfunc = printstats
+
     lowcur = lambda x: x[1]['Triangle1'] ==3
     midcur = lambda x: x[1]['Triangle1'] ==9
     hicur = lambda x: x[1]['Triangle1'] ==15
@@ -12,6 +12,7 @@ import scipy.interpolate as ip
 import scipy.optimize as op
 import matplotlib.pyplot as pyplot
 from graphframe import GraphFrame
+import dataset
 import pylab as pl
 import math
 
@@ -23,6 +24,7 @@ class MonFile:
         """Creates a MonFile object"""
         self.time = None #The amount of time that the monitor ran.
         self.spec = None #The neutron spectrum detected on the monitor.
+        self.adjusted = None #The background subtracted spectrum, binned
         if file is not None:
             self.load(file,plot)
 
@@ -39,13 +41,22 @@ class MonFile:
         return A*x**2 * np.exp(-(x-k)**2*b) + c
 
     def load(self,file,plot=True):
-        """Load data from the file given in the path string."""
+        """Load data from the file given in the path string.
+
+        The file may also be a combined dataset descriptor, in which
+        case the monitor spectra of its runs are summed, or a combined
+        cube, which holds the summed spectrum.
+
+        """
         self.time = -1
         base = 0.1
         count = 0
         uplim = 31
         
-        y = np.fromfile(file,np.int32,-1)
+        if dataset.isdataset(file) or dataset.iscube(file):
+            y = dataset.monitor(file)
+        else:
+            y = np.fromfile(file,np.int32,-1)
         x = np.arange(0,50001,1,dtype=np.float32)
         x = self.convertTime(x)
     #
@@ -82,11 +93,21 @@ class MonFile:
                 count = 0
             count += j
     #
+        self.adjusted = (xs,ysnew)
         if plot:
-            graph = GraphFrame(None,"Monitor")
-            graph2 = GraphFrame(None,"Monitor Adjusted")
-        #        graph.plot(np.arange(0.0,20.0,0.1),f(xs))
-        #    graph.plot(xs,ys)
-            graph2.plot(xs,ysnew)          
+            self.plot()
     #
         self.spec = np.expand_dims(np.expand_dims(y,axis=0),axis=0)
+
+    def plot(self):
+        """Show the monitor spectrum windows
+
+        These are wx windows, so this must run on the GUI thread.
+
+        """
+        (xs,ysnew) = self.adjusted
+        graph = GraphFrame(None,"Monitor")
+        graph2 = GraphFrame(None,"Monitor Adjusted")
+    #        graph.plot(np.arange(0.0,20.0,0.1),f(xs))
+    #    graph.plot(xs,ys)
+        graph2.plot(xs,ysnew)
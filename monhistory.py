@@ -1,22 +1,14 @@
-import xml.etree.ElementTree as ET
 import numpy as np
 import matplotlib.pyplot as plt
 import sys
-from time import strptime,mktime
-
-XMLNS = "{http://neutrons.ornl.gov/SNS/DAS/runinfo_v4_3}"
+import runcatalog
 
 BASEPATH = "C:/userfiles/EXP011/SESAME_%i/"
 
 def getRate(run):
-    format = "%Y-%m-%dT%H:%M:%S-04:00"
-    monpath = BASEPATH%run + "SESAME_%i_bmon_histo.dat"%run
-    count = np.sum(np.fromfile(monpath,dtype=np.int32))
-
-    root = ET.parse(BASEPATH%run + "SESAME_%i_runinfo.xml"%run).getroot()
-    starttime = strptime(root.find(".//"+XMLNS+"StartTime").text.strip(),format)
-    stoptime = strptime(root.find(".//"+XMLNS+"StopTime").text.strip(),format)
-    diff = mktime(stoptime) - mktime(starttime)
+    info = runcatalog.shared().run(BASEPATH%run + "SESAME_%i_runinfo.xml"%run)
+    count = info.monitor
+    diff = info.duration
 
     return [count/diff,np.sqrt(count)/diff]
 
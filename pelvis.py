@@ -9,13 +9,19 @@ by the PAPA detector.  The general workflow is:
 
 The primary class is PelvisFrame, which controls the whole program.
 PelvisFrame contains a PositionPanel, to examine single pixels, and
-a PelvisOptionPanel, which accepts user parameters.
+a PelvisOptionPanel, which accepts user parameters.  Data files are
+histogrammed by a LoadJob on worker threads, so that the window stays
+responsive and a load can be cancelled.  Large files are shown first as
+a preview made from a sample of their events.
 
 """
 
 import __future__
 
-from reader import PelFile
+from reader import PelFile, LoadCancelled
+from histcache import HistCache
+from binning import DEFAULT as BINNING
+import dataset
 from ImagePanel import ImagePanel
 from GraphPanel import GraphPanel
 from colorbarpanel import ColorBarPanel, ColorMapPicker
@@ -25,6 +31,7 @@ from SpectrumDialog import SpectrumDialog
 from tempfile import TemporaryFile
 
 import math
+import threading
 import time
 
 import numpy as np
@@ -33,7 +40,146 @@ import matplotlib.cm as cm
 
 import wx
 
-RESOLUTION = 400
+RESOLUTION = BINNING.resolution
+
+PREVIEW = 2**20 #Events sampled for a preview of a larger file
+
+def readPel(path,statusfunc,statsfunc,previewfunc):
+    """Histogram a data file and read its monitor data.
+
+    Returns the (data,mon) pair for the file, where data is the 3D
+    histogram.  statusfunc and statsfunc are handed to the PelFile.
+    If the file has more than PREVIEW events, previewfunc is first
+    called with a (data,mon) pair holding a preview of the histogram.
+    This runs on a worker thread, so the monitor isn't plotted here.
+
+    """
+    combined = dataset.isdataset(path) or dataset.iscube(path)
+    if combined:
+        mon = MonFile(path,False)
+    else:
+        mon = MonFile(path[:-17]+"bmon_histo.dat",False)
+    if path[-3:] in ("dat","npz") or combined:
+        pel = PelFile()
+        pel.statusfunc = statusfunc
+        pel.statsfunc = statsfunc
+        pel.readfileimage(path)
+        if len(pel.getevents()) > PREVIEW and pel.cached() is None:
+            previewfunc((pel.preview(PREVIEW),mon))
+        data = np.asarray(pel.make3d(),np.float32)
+    elif path[-3:] == "npy":
+        data = np.load(path)
+    return (data,mon)
+
+class LoadJob:
+    """Load a set of data files at once on worker threads
+
+    Each file gets its own thread.  Progress, averaged over all of
+    the files, and the load stats are posted back to the GUI thread,
+    where done is called with the list of (data,mon) pairs once every
+    file has loaded.  failed is called instead with a message if the
+    job is cancelled or a file can't be read.  If any of the files is
+    large enough to preview, preview is called with a list of the
+    previews, or the finished data of small files, before done.
+
+    """
+    def __init__(self,paths,progress,stats,done,failed,preview=None):
+        """Start loading the files in paths
+
+        Keyword arguments:
+        paths -- the data files to load
+        progress -- called with the overall progress out of 1000
+        stats -- called with the text of each file's load stats
+        done -- called with the list of (data,mon) pairs, in path order
+        failed -- called with the reason the job didn't finish
+        preview -- called with a list of quick (data,mon) pairs
+
+        """
+        self.paths = paths
+        self.progressfunc = progress
+        self.statsfunc = stats
+        self.done = done
+        self.failed = failed
+        self.previewfunc = preview
+        self.cancelled = False
+        self.error = None
+        self.results = [None]*len(paths)
+        self.previews = [None]*len(paths)
+        self.previewed = False #Whether any file has made a preview
+        self.progress = [0.0]*len(paths)
+        self.remaining = len(paths)
+        self.lock = threading.Lock()
+        for i in range(len(paths)):
+            thread = threading.Thread(target=self.run,args=(i,))
+            thread.daemon = True #Don't keep the program open
+            thread.start()
+
+    def cancel(self):
+        """Stop the job at the next progress update of each file"""
+        self.cancelled = True
+
+    def status(self,i,x):
+        """Record the progress of file i, or stop it if cancelled"""
+        if self.cancelled:
+            raise LoadCancelled()
+        self.progress[i] = x
+        wx.CallAfter(self.progressfunc,int(sum(self.progress)/len(self.progress)))
+
+    def preview(self,i,result):
+        """Record a preview or result of file i
+
+        Once every file has one, the previews are posted, as long as
+        at least one of them is a real preview.
+
+        """
+        with self.lock:
+            if self.previews[i] is not None:
+                return
+            self.previews[i] = result
+            ready = None not in self.previews and self.previewed
+        if ready and self.previewfunc is not None and not self.cancelled:
+            wx.CallAfter(self.previewfunc,list(self.previews))
+
+    def run(self,i):
+        """Load file i on a worker thread"""
+        def previewfunc(result):
+            self.previewed = True
+            self.preview(i,result)
+        try:
+            self.results[i] = readPel(self.paths[i],
+                                      lambda x: self.status(i,x),
+                                      lambda s: wx.CallAfter(self.statsfunc,str(s)),
+                                      previewfunc)
+            #The preview is normalized separately from the result
+            (data,mon) = self.results[i]
+            self.preview(i,(np.array(data),mon))
+        except LoadCancelled:
+            pass
+        except Exception as e:
+            #Don't let the other files carry on when this one is lost
+            self.error = "%s: %s" % (self.paths[i],e)
+            self.cancelled = True
+        with self.lock:
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            wx.CallAfter(self.finish)
+
+    def finish(self):
+        """Report the outcome of the job on the GUI thread
+
+        The monitor windows of the loaded files are opened here, as
+        wx windows can't be made on the worker threads.
+
+        """
+        if self.error is not None:
+            self.failed(self.error)
+        elif self.cancelled:
+            self.failed("Load cancelled")
+        else:
+            for (data,mon) in self.results:
+                mon.plot()
+            self.done(self.results)
 
 class PositionPanel(wx.Panel):
     """A panel with pixel information
@@ -142,11 +288,11 @@ class PelvisOptionPanel(wx.Panel):
     def getLambdaRange(self):
         """Gives a tuple with the minimum and maximum wavelength indices"""
         try:
-            lmin = int(float(self.options["lambdaMin"].GetValue())*10)
+            lmin = BINNING.index(float(self.options["lambdaMin"].GetValue()))
         except ValueError:
             lmin = 0
         try:
-            lmax = int(float(self.options["lambdaMax"].GetValue())*10)
+            lmax = BINNING.index(float(self.options["lambdaMax"].GetValue()))
         except ValueError:
             lmax = RESOLUTION
         return (lmin,lmax)
@@ -336,6 +482,7 @@ class PelvisFrame(wx.Frame):
         menubar.Append(analysismenu,"&Analysis")
         menubar.Append(noisemenu,"&Noise")
         self.SetMenuBar(menubar)
+        self.CreateStatusBar()#Shows the load stats of each file
           
         #arrange window
         sizer = wx.GridBagSizer()
@@ -346,14 +493,20 @@ class PelvisFrame(wx.Frame):
         sizer.Add(self.opPanel,pos=wx.GBPosition(0,10),span=wx.GBSpan(8,1),flag=wx.EXPAND)
         sizer.Add(self.posPanel,pos=wx.GBPosition(8,0),flag=wx.EXPAND)
         self.progress = wx.Gauge(self,range=1000)
-        sizer.Add(self.progress,pos=wx.GBPosition(9,0),span=wx.GBSpan(1,11),flag=wx.EXPAND)
+        sizer.Add(self.progress,pos=wx.GBPosition(9,0),span=wx.GBSpan(1,10),flag=wx.EXPAND)
           
         updateButton = wx.Button(self,-1,"Update")
         updateButton.Bind(wx.EVT_BUTTON,self.OnUpdateButton)
         sizer.Add(updateButton,flag=wx.EXPAND,pos=wx.GBPosition(8,10))
+
+        self.cancelButton = wx.Button(self,-1,"Cancel")
+        self.cancelButton.Bind(wx.EVT_BUTTON,self.OnCancelButton)
+        self.cancelButton.Disable()
+        sizer.Add(self.cancelButton,flag=wx.EXPAND,pos=wx.GBPosition(9,10))
           
         self.data = self.makePel()
         self.flatrun = None#background data
+        self.job = None#The LoadJob in progress
         
         sizer.SetSizeHints(self)
         self.SetSizer(sizer)
@@ -366,28 +519,60 @@ class PelvisFrame(wx.Frame):
             self.progress.SetValue(x)
             self.Yield()
         data.statusfunc = statusfunc
+        def statsfunc(stats):
+            self.SetStatusText(str(stats))
+        data.statsfunc = statsfunc
         return data
-    def loadPel(self,message):
-        """Load a .pel file and its monitor data.
+    def choosePel(self,message):
+        """Ask for a .pel file, returning its path or None
         
         Keyword arguments:
         message -- The title for the load file dialog.
         
         """
-        dlg=wx.FileDialog(self,message,wildcard="He3 data|*neutron_event.dat|Preformatted Histograms|*.npy",style=wx.FD_OPEN)
+        dlg=wx.FileDialog(self,message,wildcard="He3 data|*neutron_event.dat|Combined datasets|*"+dataset.SUFFIX+"|Combined cubes|*"+dataset.CUBESUFFIX+"|Histogram archives|*neutron_event.npz|Preformatted Histograms|*.npy",style=wx.FD_OPEN)
         if dlg.ShowModal()==wx.ID_OK:
-        #            self.SetCursor(wx.CURSOR_WAIT)
-            path = dlg.GetPath()
-            if path[-3:] == "dat":
-                data = self.makePel()
-                data.readfileimage(path)
-            elif path[-3:] == "npy":
-                data = np.load(path)
-        #            self.SetCursor(wx.CURSOR_ARROW)
-        else:
-            return (None,None)
-        mon = MonFile(path[:-17]+"bmon_histo.dat")
-        return (data,mon)
+            return dlg.GetPath()
+        return None
+
+    def loadPel(self,paths,done,preview=None):
+        """Load .pel files and their monitor data in the background.
+
+        Any load already running is cancelled.  done is called with
+        a list of (data,mon) pairs, one for each path, once they have
+        all been loaded.  If the files are large, preview is called
+        with a list of quick previews of them first.
+
+        """
+        if self.job is not None:
+            self.job.cancel()
+        def finished(results):
+            self.endLoad(job)
+            done(results)
+        def failed(reason):
+            self.endLoad(job)
+            self.SetStatusText(reason)
+        def previewed(results):
+            if self.job is job and preview is not None:
+                preview(results)
+                self.SetStatusText("Preview from sampled events, "
+                                   "the full histogram is on its way")
+        job = LoadJob(paths,self.progress.SetValue,self.SetStatusText,
+                      finished,failed,previewed)
+        self.job = job
+        self.cancelButton.Enable()
+
+    def endLoad(self,job):
+        """Tidy up after a LoadJob has finished"""
+        if self.job is job:
+            self.job = None
+            self.cancelButton.Disable()
+        self.progress.SetValue(0)
+
+    def OnCancelButton(self,event):
+        """Stop the file load in progress"""
+        if self.job is not None:
+            self.job.cancel()
 
     
     def OnImageArray(self,event):
@@ -400,22 +585,19 @@ class PelvisFrame(wx.Frame):
             (lmin,lmax) = self.opPanel.getLambdaRange()
             for i in range(lmin,lmax):
                 file=path+("%03i"%i)+ext
-                self.opPanel.setLambdaRange(0.1*i,0.1*(i+1))
+                self.opPanel.setLambdaRange(BINNING.edges[i],BINNING.edges[i+1])
                 self.updateData()
                 self.update()
                 self.imPanel.saveImage(file)
                 self.progress.SetValue(1000*(i-lmin)/(lmax-lmin))
                 self.Yield()
-            self.opPanel.setLambdaRange(lmin*0.1,lmax*0.1)
+            self.opPanel.setLambdaRange(BINNING.edges[lmin],BINNING.edges[lmax])
             self.updateData()
             self.progress.SetValue(0)
 
     
-    def loadNormPel(self,message):
-        """Load a .pel file, normalize it by monitor, and subtract background"""
-        (data,mon) = self.loadPel(message)
-        if isinstance(data,PelFile):
-            data = np.asarray(data.make3d(),np.float32)
+    def normPel(self,data,mon):
+        """Normalize loaded data by monitor, and subtract background"""
         if mon is None:
             return (data,1)
         if self.flatrun != None:
@@ -515,12 +697,16 @@ class PelvisFrame(wx.Frame):
 
     def OnOpen(self,event):
         """Load a single .pel file for display"""
-        data,scale = self.loadNormPel("Choose the Pel File to Open")
-        if data is None:
+        path = self.choosePel("Choose the Pel File to Open")
+        if path is None:
             return
+        self.loadPel([path],self.openLoaded,self.openLoaded)
+
+    def openLoaded(self,results):
+        """Display a single loaded .pel file, or a preview of it"""
+        data,scale = self.normPel(*results[0])
         self.data = data
         self.scale = scale
-        self.progress.SetValue(0)
         self.specDlg.setMode("up")
         self.updateData = self.updateSingleData
         self.update = self.updateSingle
@@ -528,18 +714,18 @@ class PelvisFrame(wx.Frame):
 
     def OnOpenSet(self,event):
         """Load a spin flip measurement for display"""
-        if self.loadUpAndDown():
-            self.OnPolar(event)
+        self.loadUpAndDown(lambda: self.OnPolar(event))
 
     def OnFlat(self,event):
         """Load a blank run for background subtraction"""
-        (data,mon) = self.loadPel("Choose a Blank Run")
-        if data == None:
+        path = self.choosePel("Choose a Blank Run")
+        if path is None:
             return
-        if isinstance(data,PelFile):
-            flatrun = data.make3d()
-        elif isinstance(data,np.ndarray):
-            flatrun = data
+        self.loadPel([path],self.flatLoaded)
+
+    def flatLoaded(self,results):
+        """Store a loaded blank run for background subtraction"""
+        (flatrun,mon) = results[0]
         flatrun = np.sum(flatrun,axis=2)
         flatrun /= RESOLUTION
         flatrun /= float(mon.time)
@@ -547,7 +733,6 @@ class PelvisFrame(wx.Frame):
         self.flatrun = TemporaryFile()
         np.save(self.flatrun,flatrun)
         self.flatrun.seek(0)
-        self.progress.SetValue(0)
       
     def OnFakeFlat(self,event):
         """Create a fake background run from outside the region of interest."""
@@ -724,16 +909,26 @@ class PelvisFrame(wx.Frame):
     def OnExit(self,event):
           """Quit the program"""
           self.Close()
-    def loadUpAndDown(self):
-        """Read in spin flip data"""
-        u3d,uscale = self.loadNormPel("Spin Up State")
-        if u3d is None:
-            return False
-        del self.data
-        d3d,dscale = self.loadNormPel("Spin Down State")
-        self.data = (u3d,d3d)
-        self.scale = (uscale,dscale)
-        return True
+    def loadUpAndDown(self,done):
+        """Read in spin flip data
+
+        Both files are chosen first and then loaded at the same time.
+        done is called once the data is in place.
+
+        """
+        up = self.choosePel("Spin Up State")
+        if up is None:
+            return
+        down = self.choosePel("Spin Down State")
+        if down is None:
+            return
+        def loaded(results):
+            u3d,uscale = self.normPel(*results[0])
+            d3d,dscale = self.normPel(*results[1])
+            self.data = (u3d,d3d)
+            self.scale = (uscale,dscale)
+            done()
+        self.loadPel([up,down],loaded,loaded)
 
     def OnPolar(self,event):
         """Display neutron polarization"""
@@ -775,6 +970,7 @@ class PelvisFrame(wx.Frame):
 
 
 if __name__=="__main__":
+    PelFile.cache = HistCache()
     app=wx.PySimpleApp()
     pelvisframe = PelvisFrame(app.Yield)
     app.MainLoop()
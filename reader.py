@@ -8,56 +8,455 @@ the format of these files can be found in the Lexitech PAPA Software Manual.
 
 import __future__
 
+import os
 import struct
+import zlib
+import multiprocessing
 #import re
 import numpy as np
 
-from time import clock
+from timeit import default_timer
 from collections import namedtuple
 
-RESOLUTION = 400
-
-def mapim(imarray):
-    XDIM=8
-    YDIM=256
-    XDIMIM=16
-    YDIMIM=128
-    ZPAD=0
-#    maparray=[2, 15, 1, 16, 4, 13, 3, 14, 6, 11, 5, 12, 8, 9, 7, 10]
-#    maparray =[2, 1, 4, 3, 6, 5, 8, 7, 10, 9, 12, 11, 14, 13, 16, 15]#Old July 2013
-#    maparray =[2, 1, 4, 3, 6, 5, 8, 7, 14, 10, 13, 12, 9, 11, 16, 15]# SESANS October 2013
-#    maparray =[2, 1, 4, 3, 6, 5, 8, 7, 14, 10, 13, 12, 9, 11, 16, 15]# SESANS July 2013
-    maparray =[4, 3, 1, 2, 6, 5, 15, 16, 8, 13, 7, 14, 10, 11, 9, 12] # From tube mapping October 2013
-    #    maparray = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
-#    maparray = [12, 9, 11, 14, 10, 7, 1, 2, 3, 4, 5, 6, 8, 13, 15, 16]
-#    maparray =[2, 1, 4, 3, 6, 15, 5, 16, 8, 7, 13, 14, 11, 12, 9, 10]
-#    maparray =[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
-    newimarray=np.zeros((YDIMIM+ZPAD,XDIMIM))
-    for i in range(len(maparray)):
-        ti=maparray[i]
-        if 0.5*ti!=int(0.5*ti):
-           for j in range(YDIMIM):
-                tj=j
-                if ti<9:
-                    newimarray[j+ZPAD,i]=imarray[YDIMIM-1-tj,(ti-1)/2]
-                else:
-                    newimarray[j,i]=imarray[YDIMIM-1-tj,(ti-1)/2]
+import binning
+import dataset
+
+RESOLUTION = binning.DEFAULT.resolution
+
+#A single detector event, as stored in a neutron_event.dat file
+EVENT = np.dtype([("time",np.int32),("position",np.int32)])
+
+#Cabling of the sixteen tubes.  Entry i of a map is the raw tube number
+#which feeds column i of the detector image.
+TUBEMAPS = {"october2013":[4, 3, 1, 2, 6, 5, 15, 16, 8, 13, 7, 14, 10, 11, 9, 12], # From tube mapping October 2013
+            "july2013":[2, 1, 4, 3, 6, 5, 8, 7, 10, 9, 12, 11, 14, 13, 16, 15],#Old July 2013
+            "sesans2013":[2, 1, 4, 3, 6, 5, 8, 7, 14, 10, 13, 12, 9, 11, 16, 15],# SESANS July and October 2013
+            "paired":[2, 15, 1, 16, 4, 13, 3, 14, 6, 11, 5, 12, 8, 9, 7, 10],
+            "straight":[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16],
+            #Two more maps which were left unlabelled in the old mapim
+            "unnamed1":[12, 9, 11, 14, 10, 7, 1, 2, 3, 4, 5, 6, 8, 13, 15, 16],
+            "unnamed2":[2, 1, 4, 3, 6, 15, 5, 16, 8, 7, 13, 14, 11, 12, 9, 10]}
+TUBEMAP = "october2013" #The map used unless a PelFile asks for another
+
+_compiled = {} #Pixel lookups for the maps which have already been compiled
+
+def compile_tubemap(maparray):
+    """Turn a tube map into a pixel lookup table
+
+    Returns an array indexed by the raw position data whose values
+    are the flattened (y,x) pixel of the 128x16 detector image.  Each
+    raw tube holds two image tubes, with the odd tube in the bottom
+    half of the raw positions and the even tube, reversed, in the top.
+    The map must use each of the tubes 1 to 16 exactly once.
+
+    """
+    if sorted(maparray) != list(range(1,17)):
+        raise ValueError("A tube map must use each of the tubes 1 to 16 once")
+    pixels = np.empty(8*256,dtype=np.intp)
+    y = np.arange(128)
+    for x,tube in enumerate(maparray):
+        column = 256*((tube-1)//2)
+        if tube%2:
+            pixels[column+y] = 16*y+x
         else:
-            for j in range(YDIMIM):
-                tj=j+YDIMIM
-                if ti<9:
-                    newimarray[j+ZPAD,i]=imarray[tj,ti/2-1]
-                else:
-                    newimarray[j,i]=imarray[tj,ti/2-1]
-    return newimarray
+            pixels[column+255-y] = 16*y+x
+    return pixels
+
+def pixelmap(name=None):
+    """Get the pixel lookup table for the named tube map"""
+    if name is None:
+        name = TUBEMAP
+    if name not in _compiled:
+        _compiled[name] = compile_tubemap(TUBEMAPS[name])
+    return _compiled[name]
+
+def mapim(imarray,name=None):
+    """Move a 256x8 raw tube image into the 128x16 detector layout"""
+    image = np.zeros(128*16)
+    image[pixelmap(name)] = np.ravel(imarray,order="F")
+    return image.reshape(128,16)[::-1,:]
+
+def mapevents(path):
+    """Map an event file into memory as an array of EVENT records
+
+    Nothing is read from the disk until the records are used, and then
+    only the pages holding the records which are touched.  A trailing
+    partial event is ignored.
+
+    """
+    count = os.path.getsize(path)//EVENT.itemsize
+    if count == 0:
+        #np.memmap refuses to map an empty file
+        return np.zeros(0,dtype=EVENT)
+    return np.memmap(path,dtype=EVENT,mode="r",shape=(count,))
+
+#The fields of a PEL file header
+Header = namedtuple(
+        'Header',
+        "pel endian FileMajVer FileMinVer BytesPerSample " +
+        "SysHealth AppMajVer AppMinVer AppBetaVer LensPos " +
+        "DetectorName ProductNumber BitsPerCoord CanEnergy " +
+        "CanTime ADclockFrequ FirmMajVer FirmMinVer FirmBeta Serial " +
+        "AcquisitionMode CanAcqMode Shutter " +
+        "PAPAPowerSupplyVoltageCommand " +
+        "PAPAPowerSupplyVoltageCommandGain " +
+        "PAPAPowerSupplyVoltageCommandOffset " +
+        "PAPAPowerSupplyControlVoltageCommandGain " +
+        "PAPAPowerSupplyControlVoltageCommandOffset " +
+        "PAPAPowerSupplyVoltageEnable " +
+        "EnergyPowerSupplyVoltageCommand " +
+        "EnergyPowerSupplyVoltageCommandGain " +
+        "EnergyPowerSupplyVoltageCommandOffset " +
+        "EnergyPowerSupplyControlVoltageCommandGain " +
+        "EnergyPowerSupplyControlVoltageCommandOffset " +
+        "EnergyPowerSupplyVoltageEnable " +
+        "MCPPowerSupplyVoltageCommand " +
+        "MCPPowerSupplyVoltageCommandGain " +
+        "MCPPowerSupplyVoltageCommandOffset " +
+        "MCPPowerSupplyControlVoltageCommandGain " +
+        "MCPPowerSupplyControlVoltageCommandOffset " +
+        "MCPPowerSupplyVoltageEnable " +
+        "x1Gain x2Gain x3Gain x4Gain x5Gain x6Gain x7Gain x8Gain x9Gain x10Gain " +
+
+        "y1Gain y2Gain y3Gain y4Gain y5Gain y6Gain y7Gain y8Gain y9Gain y10Gain " +
+        "strobeGain EnergyGain ThresholdGain "+
+        "ADVoltageOffset ADAOffset ADBOffset ADCOffset ADDOffset "+
+        "StrobeTriggerMin StrobeTriggerMax StrobeEndEventFrac " +
+        "EnergyTriggerMin EnergyTriggerMax EnergyEndEventFrac " +
+        "ADAFillSampleIntervalLength ADDFillSampleIntervalLength " +
+        "GateCapturePolarity TimerResetEdgePolarity " +
+        "LeadTimer LagTimer Gray BitShift " +
+        "TemperatureSetPoint1 TemperatureSetPoint2 " +
+        "KP1 KP2 KI1 KI2 KD1 KD2 Temperature1 Temperature2 " +
+        "StrobePulseWidth " +
+        "Year Month Day Hour Minute Second")
+
+#The layout of a PEL file header, less the byte order
+HEADERFORMAT = "4s ?" #header and endian
+HEADERFORMAT += "B" #Major version
+HEADERFORMAT += "B" #Minor Version
+HEADERFORMAT += "B" #Bytes per sample
+HEADERFORMAT += "B" #System Health
+HEADERFORMAT += "B" #Application Software Major Version
+HEADERFORMAT += "B" #Application Software Minor Version
+HEADERFORMAT += "B" #Application Software Beta Version
+HEADERFORMAT += "H" #Lens focus position
+HEADERFORMAT += " 40s " # Detector Name
+HEADERFORMAT += "H" # Product Number
+HEADERFORMAT += "B" # Bits per coordinate
+HEADERFORMAT += "B" #Detector Energy Capability
+HEADERFORMAT += "B" #Detector Timing Capability
+HEADERFORMAT += "H" #AD Clock Frequency
+HEADERFORMAT += "B" #Firmware Major Version
+HEADERFORMAT += "B" #Firmware Minor Version
+HEADERFORMAT += "B" #Firmware Beta Version
+HEADERFORMAT += "H" #Serial Number
+HEADERFORMAT += "B" #Acquisition Mode
+HEADERFORMAT += "I" #Acquisition Mode Capability
+HEADERFORMAT += "B" #Shutter State
+HEADERFORMAT += "H" #PAPA PMT power supply voltage command
+HEADERFORMAT += "H" #PAPA PMT power supply voltage gain
+HEADERFORMAT += "H" #PAPA PMT power supply voltage command offset
+HEADERFORMAT += "H" #PAPA PMT power supply control voltage command gain
+HEADERFORMAT += "H" #PAPA PMT power supply control voltage command offsert
+HEADERFORMAT += "B" #PAPA PMT power supply voltage enable
+
+HEADERFORMAT += "H" #Energy PMT power supply voltage command
+HEADERFORMAT += "H" #Energy PMT power supply voltage gain
+HEADERFORMAT += "H" #Energy PMT power supply voltage command offset
+HEADERFORMAT += "H" #Energy PMT power supply control voltage command gain
+HEADERFORMAT += "H" #Energy PMT power supply control voltage command offsert
+HEADERFORMAT += "B" #Energy PMT power supply voltage enable
+HEADERFORMAT += "H" #Intensifier MCP power supply voltage command
+HEADERFORMAT += "H" #Intensifier MCP power supply voltage gain
+HEADERFORMAT += "H" #Intensifier MCP power supply voltage command offset
+HEADERFORMAT += "H" #Intensifier MCP power supply control voltage command gain
+HEADERFORMAT += "H" #Intensifier MCP power supply control voltage command offsert
+HEADERFORMAT += "B" #Intensifier MCP power supply voltage enable
+HEADERFORMAT += " 10H " #X Channel gains
+HEADERFORMAT += " 10H " #Y Channel gains
+HEADERFORMAT += "H" #Strobe PMT Channel Gain
+HEADERFORMAT += "H" #Energy PMT Channel Gain
+HEADERFORMAT += "H" #Threshold Channel Gain
+HEADERFORMAT += "H" #AD Voltage Offset
+HEADERFORMAT += "H" #AD Channel A Offset
+HEADERFORMAT += "H" #AD Channel B Offset
+HEADERFORMAT += "H" #AD Channel C Offset
+HEADERFORMAT += "H" #AD Channel D Offset
+HEADERFORMAT += "H" #PAPA Strobe Trigger min
+HEADERFORMAT += "H" #PAPA Strobe Trigger max
+HEADERFORMAT += "H" #PAPA Strobe end event fraction
+HEADERFORMAT += "H" #Energy Trigger min
+HEADERFORMAT += "H" #Energy Trigger max
+HEADERFORMAT += "H" #Energy end event fraction
+HEADERFORMAT += "B" #AD A filter sample interval length
+HEADERFORMAT += "B" #AD D filter sample interval length
+HEADERFORMAT += "B" #Gate Capture Polarity
+HEADERFORMAT += "B" #Timer reset edge Polarity
+HEADERFORMAT += "H" #Coincidence lead timer
+HEADERFORMAT += "H" #Coincidence lag timer
+HEADERFORMAT += "B" #Gray to binary conversion adder
+HEADERFORMAT += "B" #Binary big shift
+HEADERFORMAT += " 2H " #Zone temperature set point
+HEADERFORMAT += " 2H " #Zone KP Gain
+HEADERFORMAT += " 2H " #Zone KI Gain
+HEADERFORMAT += " 2H " #Zone KD Gain
+HEADERFORMAT += " 2H " #Zone temperature
+HEADERFORMAT += "H" #strobe pulse width
+HEADERFORMAT += "39x" #unused
+HEADERFORMAT += "H" #Year
+HEADERFORMAT += "H" #Month
+HEADERFORMAT += "H" #Day
+HEADERFORMAT += "H" #Hour
+HEADERFORMAT += "H" #Minute
+HEADERFORMAT += "H" #Second
+HEADERSIZE = 256
+#The compiled header layouts, indexed by the endian flag in the fifth byte
+HEADERSTRUCTS = {False:struct.Struct("<"+HEADERFORMAT), #little endian
+                 True:struct.Struct(">"+HEADERFORMAT)} #big endian
+
+INDEXMAGIC = b"PELIDX01" #Marks a pixel sorted event index
+
+def writeindex(path,out,chunksize=2**22):
+    """Rewrite an event file as a pixel sorted index
+
+    The index starts with INDEXMAGIC and the pixel and event counts as
+    int64s.  Then comes an int64 table giving where each raw pixel's
+    events start, with the total at the end, followed by the int32 TOF
+    of every event, grouped by pixel and sorted within each pixel.
+    Events with positions off the detector are left out.  The events
+    are scattered into place a chunk at a time, so the memory used
+    doesn't grow with the file.
+
+    """
+    events = mapevents(path)
+    pixels = 8*256
+    counts = np.zeros(pixels,dtype=np.int64)
+    for start in range(0,len(events),chunksize):
+        Z = events[start:start+chunksize]["position"] & 0xFFFF
+        counts += np.bincount(Z[Z <= pixels],minlength=pixels+1)[:pixels]
+        counts[-1] += np.sum(Z == pixels)
+    offsets = np.zeros(pixels+1,dtype=np.int64)
+    np.cumsum(counts,out=offsets[1:])
+    header = np.array([pixels,offsets[-1]],dtype=np.int64)
+    with open(out,"wb") as stream:
+        stream.write(INDEXMAGIC)
+        header.tofile(stream)
+        offsets.tofile(stream)
+        start = stream.tell()
+        if offsets[-1] > 0:
+            stream.seek(start+4*int(offsets[-1])-1)
+            stream.write(b"\0")
+    if offsets[-1] == 0:
+        return
+    tof = np.memmap(out,dtype=np.int32,mode="r+",offset=start,
+                    shape=(int(offsets[-1]),))
+    cursor = offsets[:-1].copy()
+    for first in range(0,len(events),chunksize):
+        block = events[first:first+chunksize]
+        Z = block["position"] & 0xFFFF
+        keep = Z <= pixels
+        Z = np.minimum(Z[keep],pixels-1)
+        times = block["time"][keep]
+        order = np.argsort(Z,kind="mergesort")
+        Z = Z[order]
+        #Each event goes after those of its pixel already written
+        found = np.bincount(Z,minlength=pixels)
+        groups = np.zeros(pixels,dtype=np.int64)
+        np.cumsum(found[:-1],out=groups[1:])
+        tof[cursor[Z]+np.arange(len(Z))-groups[Z]] = times[order]
+        cursor += found
+    for p in range(pixels):
+        tof[offsets[p]:offsets[p+1]].sort()
+    tof.flush()
+    del tof
+
+class EventIndex:
+    """A pixel sorted event index, as written by writeindex"""
+    def __init__(self,path):
+        """Map the index file in path"""
+        with open(path,"rb") as stream:
+            if stream.read(len(INDEXMAGIC)) != INDEXMAGIC:
+                raise ValueError(path + " is not an event index")
+            self.pixels,self.events = np.fromfile(stream,np.int64,2)
+        start = len(INDEXMAGIC)+2*8
+        self.offsets = np.memmap(path,dtype=np.int64,mode="r",offset=start,
+                                 shape=(self.pixels+1,))
+        start += 8*(self.pixels+1)
+        if self.events == 0:
+            self.tof = np.zeros(0,dtype=np.int32)
+        else:
+            self.tof = np.memmap(path,dtype=np.int32,mode="r",offset=start,
+                                 shape=(self.events,))
+
+    def counts(self,tofmin,tofmax):
+        """Count each raw pixel's events with tofmin <= TOF < tofmax
+
+        Only the two ends of each pixel's sorted TOFs are searched, so
+        this never reads more than a handful of pages per pixel.
+
+        """
+        counts = np.zeros(self.pixels,dtype=np.int64)
+        for p in range(self.pixels):
+            tof = self.tof[self.offsets[p]:self.offsets[p+1]]
+            if len(tof):
+                counts[p] = (np.searchsorted(tof,tofmax) -
+                             np.searchsorted(tof,tofmin))
+        return counts
+
+    def blocks(self,chunksize):
+        """Iterate over the index as EVENT records, chunksize at a time"""
+        for start in range(0,self.events,chunksize):
+            stop = min(start+chunksize,self.events)
+            block = np.empty(stop-start,dtype=EVENT)
+            block["time"] = self.tof[start:stop]
+            block["position"] = np.searchsorted(self.offsets,
+                                                np.arange(start,stop),
+                                                side="right")-1
+            yield block
+
+class EventChain:
+    """Several event files read as one array of EVENT records
+
+    This is how a combined dataset is read.  Each member file is
+    mapped into memory, and slicing the chain only touches the files
+    which hold the slice.  A slice which crosses from one file to the
+    next is copied into memory, as is a whole field, so reductions go
+    through blocks instead.
+
+    """
+    def __init__(self,paths):
+        """Map the event files in paths, in order"""
+        self.paths = list(paths)
+        self.parts = [mapevents(path) for path in self.paths]
+        self.starts = np.cumsum([0]+[len(part) for part in self.parts])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self,key):
+        if isinstance(key,str):
+            return np.concatenate([part[key] for part in self.parts] +
+                                  [np.zeros(0,dtype=EVENT[key])])
+        start,stop,step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("Event chains can only be sliced contiguously")
+        pieces = [part[max(start-first,0):stop-first]
+                  for (first,part) in zip(self.starts,self.parts)
+                  if first < stop and first+len(part) > start]
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces+[np.zeros(0,dtype=EVENT)])
+
+    def blocks(self,start,chunksize):
+        """Iterate over the events from event start in blocks of chunksize
+
+        A block never crosses from one file to the next, so each is a
+        view into a single mapped file and nothing is copied.
+
+        """
+        for (path,first,last) in self.pieces(start,len(self)):
+            part = self.parts[self.paths.index(path)]
+            for begin in range(first,last,chunksize):
+                yield part[begin:min(begin+chunksize,last)]
+
+    def pieces(self,start,stop):
+        """The (path,first,last) ranges of the files from event start to stop"""
+        return [(path,max(start-first,0),min(stop-first,len(part)))
+                for (path,first,part) in zip(self.paths,self.starts,self.parts)
+                if len(part) and first < stop and first+len(part) > start]
+
+#The stages of a load, in the order the events pass through them
+STAGES = ("read","decode","tof","remap","histogram")
+
+class LoadStats:
+    """Where the time went while loading and histogramming an event file
+
+    seconds holds the time spent in each of STAGES.  Pages of a mapped
+    file are only read from the disk when they are first decoded, so
+    the disk time of an uncached file shows up under decode.  With
+    several workers, the stage times are summed over the workers while
+    elapsed is the wall clock time.
+
+    """
+    def __init__(self):
+        self.seconds = dict((stage,0.0) for stage in STAGES)
+        self.elapsed = 0.0 #Wall clock time of all the work on the file
+        self.events = 0 #Events histogrammed
+        self.bytes = 0 #Bytes of events read
+        self.cached = False #Whether a cube came from the histogram cache
+
+    def merge(self,other):
+        """Add the stages and counts of another LoadStats to this one"""
+        for stage in STAGES:
+            self.seconds[stage] += other.seconds[stage]
+        self.events += other.events
+        self.bytes += other.bytes
+        self.cached = self.cached or other.cached
+
+    def rate(self):
+        """Events histogrammed per second of wall clock time"""
+        if self.elapsed == 0:
+            return 0.0
+        return self.events/self.elapsed
+
+    def __str__(self):
+        text = "%i events, %.1f MB in %.3f s (%.3g events/s)" % \
+               (self.events,self.bytes/2.0**20,self.elapsed,self.rate())
+        text += ": " + ", ".join(["%s %.3f s" % (stage,self.seconds[stage])
+                                  for stage in STAGES])
+        if self.cached:
+            text += ", cube from cache"
+        return text
+
+def printstats(pel,stats):
+    """A PelFile.statsfunc which prints the stats of every load"""
+    print("%s: %s" % (pel.path,stats))
+
+class LoadCancelled(Exception):
+    """Raised by a statusfunc to abandon the load it is reporting on"""
+    pass
+
+#PelFile attributes which change how events are counted
+SETTINGS = ("tubemap","chunksize","binning")
+
+def _countrange(task):
+    """Count ranges of event files in a worker process
+
+    The task holds a list of (path,first,last) event ranges, which
+    is a single range unless the events come from an EventChain.
+
+    """
+    pieces,settings,keep = task
+    pel = PelFile()
+    for (name,value) in settings:
+        setattr(pel,name,value)
+    counts = 0
+    for (path,first,last) in pieces:
+        pel.data = np.memmap(path,dtype=EVENT,mode="r",
+                             offset=first*EVENT.itemsize,
+                             shape=(last-first,)).view(np.int32)
+        counts = counts+pel.count(keep)
+    return counts,pel.stats
 
 class PelFile:
         """Handles the data stored in PEL files"""
         data = np.ndarray(shape=(0),dtype=np.int64)#Raw detector data
+        tubemap = TUBEMAP #Name of the tube cabling in TUBEMAPS
+        chunksize = 2**22 #Events histogrammed at once, which bounds memory use
+        workers = 1 #Processes used to histogram files
+        path = None #The event file the data was mapped from
+        index = None #The EventIndex, if the data came from one
+        chain = None #The EventChain, if the data came from a combined dataset
+        cube = None #The cube, if the data came from a cube archive
+        cache = None #A histcache.HistCache to keep cubes in between runs
+        running = None #(events,counts,check) of the counts kept by update
+        binning = binning.DEFAULT #Wavelength bins and flight path
 
         
         def __init__(self,file=""):
                 """Create a PelFile"""
+                self.stats = LoadStats()
                 if(file!=""):
                         self.readfileimage(file)
                         
@@ -65,135 +464,13 @@ class PelFile:
         
         def parseHeader(self,bytes):
                 """Turn the Pel file header into structured data"""
-                Header = namedtuple(
-                        'Header',
-                        "pel endian FileMajVer FileMinVer BytesPerSample " +
-                        "SysHealth AppMajVer AppMinVer AppBetaVer LensPos " +
-                        "DetectorName ProductNumber BitsPerCoord CanEnergy " +
-                        "CanTime ADclockFrequ FirmMajVer FirmMinVer FirmBeta Serial " +
-                        "AcquisitionMode CanAcqMode Shutter " +
-                        "PAPAPowerSupplyVoltageCommand " +
-                        "PAPAPowerSupplyVoltageCommandGain " +
-                        "PAPAPowerSupplyVoltageCommandOffset " +
-                        "PAPAPowerSupplyControlVoltageCommandGain " +
-                        "PAPAPowerSupplyControlVoltageCommandOffset " +
-                        "PAPAPowerSupplyVoltageEnable " +
-                        "EnergyPowerSupplyVoltageCommand " +
-                        "EnergyPowerSupplyVoltageCommandGain " +
-                        "EnergyPowerSupplyVoltageCommandOffset " +
-                        "EnergyPowerSupplyControlVoltageCommandGain " +
-                        "EnergyPowerSupplyControlVoltageCommandOffset " +
-                        "EnergyPowerSupplyVoltageEnable " +
-                        "MCPPowerSupplyVoltageCommand " +
-                        "MCPPowerSupplyVoltageCommandGain " +
-                        "MCPPowerSupplyVoltageCommandOffset " +
-                        "MCPPowerSupplyControlVoltageCommandGain " +
-                        "MCPPowerSupplyControlVoltageCommandOffset " +
-                        "MCPPowerSupplyVoltageEnable " +
-                        "x1Gain x2Gain x3Gain x4Gain x5Gain x6Gain x7Gain x8Gain x9Gain x10Gain " +
-        
-                        "y1Gain y2Gain y3Gain y4Gain y5Gain y6Gain y7Gain y8Gain y9Gain y10Gain " +
-                        "strobeGain EnergyGain ThresholdGain "+
-                        "ADVoltageOffset ADAOffset ADBOffset ADCOffset ADDOffset "+
-                        "StrobeTriggerMin StrobeTriggerMax StrobeEndEventFrac " +
-                        "EnergyTriggerMin EnergyTriggerMax EnergyEndEventFrac " +
-                        "ADAFillSampleIntervalLength ADDFillSampleIntervalLength " +
-                        "GateCapturePolarity TimerResetEdgePolarity " +
-                        "LeadTimer LagTimer Gray BitShift " +
-                        "TemperatureSetPoint1 TemperatureSetPoint2 " +
-                        "KP1 KP2 KI1 KI2 KD1 KD2 Temperature1 Temperature2 " +
-                        "StrobePulseWidth " +
-                        "Year Month Day Hour Minute Second")
-        
-        
-                format = "4s" #header
-                format += " ?" #endian  Note that this is currently ignored
-                (pelstring,endian) = struct.unpack(format,bytes[0:5])
-        
-                if endian:
-                        format = ">" #big endian
-                else:
-                        format = "<" #little endian
-                format += "4s ?" #header and endian
-                format += "B" #Major version
-                format += "B" #Minor Version
-                format += "B" #Bytes per sample
-                format += "B" #System Health
-                format += "B" #Application Software Major Version
-                format += "B" #Application Software Minor Version
-                format += "B" #Application Software Beta Version
-                format += "H" #Lens focus position
-                format += " 40s " # Detector Name
-                format += "H" # Product Number
-                format += "B" # Bits per coordinate
-                format += "B" #Detector Energy Capability
-                format += "B" #Detector Timing Capability
-                format += "H" #AD Clock Frequency
-                format += "B" #Firmware Major Version
-                format += "B" #Firmware Minor Version
-                format += "B" #Firmware Beta Version
-                format += "H" #Serial Number
-                format += "B" #Acquisition Mode
-                format += "I" #Acquisition Mode Capability
-                format += "B" #Shutter State
-                format += "H" #PAPA PMT power supply voltage command
-                format += "H" #PAPA PMT power supply voltage gain
-                format += "H" #PAPA PMT power supply voltage command offset
-                format += "H" #PAPA PMT power supply control voltage command gain
-                format += "H" #PAPA PMT power supply control voltage command offsert
-                format += "B" #PAPA PMT power supply voltage enable
-        
-                format += "H" #Energy PMT power supply voltage command
-                format += "H" #Energy PMT power supply voltage gain
-                format += "H" #Energy PMT power supply voltage command offset
-                format += "H" #Energy PMT power supply control voltage command gain
-                format += "H" #Energy PMT power supply control voltage command offsert
-                format += "B" #Energy PMT power supply voltage enable
-                format += "H" #Intensifier MCP power supply voltage command
-                format += "H" #Intensifier MCP power supply voltage gain
-                format += "H" #Intensifier MCP power supply voltage command offset
-                format += "H" #Intensifier MCP power supply control voltage command gain
-                format += "H" #Intensifier MCP power supply control voltage command offsert
-                format += "B" #Intensifier MCP power supply voltage enable
-                format += " 10H " #X Channel gains
-                format += " 10H " #Y Channel gains
-                format += "H" #Strobe PMT Channel Gain
-                format += "H" #Energy PMT Channel Gain
-                format += "H" #Threshold Channel Gain
-                format += "H" #AD Voltage Offset
-                format += "H" #AD Channel A Offset
-                format += "H" #AD Channel B Offset
-                format += "H" #AD Channel C Offset
-                format += "H" #AD Channel D Offset
-                format += "H" #PAPA Strobe Trigger min
-                format += "H" #PAPA Strobe Trigger max
-                format += "H" #PAPA Strobe end event fraction
-                format += "H" #Energy Trigger min
-                format += "H" #Energy Trigger max
-                format += "H" #Energy end event fraction
-                format += "B" #AD A filter sample interval length
-                format += "B" #AD D filter sample interval length
-                format += "B" #Gate Capture Polarity
-                format += "B" #Timer reset edge Polarity
-                format += "H" #Coincidence lead timer
-                format += "H" #Coincidence lag timer
-                format += "B" #Gray to binary conversion adder
-                format += "B" #Binary big shift
-                format += " 2H " #Zone temperature set point
-                format += " 2H " #Zone KP Gain
-                format += " 2H " #Zone KI Gain
-                format += " 2H " #Zone KD Gain
-                format += " 2H " #Zone temperature
-                format += "H" #strobe pulse width
-                format += "39x" #unused
-                format += "H" #Year
-                format += "H" #Month
-                format += "H" #Day
-                format += "H" #Hour
-                format += "H" #Minute
-                format += "H" #Second
-                header = Header._make(struct.unpack(format,bytes))
-                return header
+                (endian,) = struct.unpack("?",bytes[4:5])
+                return Header._make(HEADERSTRUCTS[endian].unpack(bytes[:HEADERSIZE]))
+
+        def peakheader(self,path):
+                """Read only the header of a Pel file"""
+                with open(path,"rb") as infile:
+                        return self.parseHeader(infile.read(HEADERSIZE))
         
         #Remember to use in-place operations to save on memory overhead
         def convertTime(self,timearr):
@@ -201,59 +478,359 @@ class PelFile:
                 #convert timearr into microseconds
                 timearr *= 0.1 #Convert to microseconds
                 #convert timearr into wavelength
-                distanceToG4 = 3.7338+2.5297
-                distanceToDetector = 3.835 #FIXME
-                timearr -= 860
-                timearr *= 3.956034e-7/(distanceToDetector+distanceToG4)/1e-10*1e-6*(RESOLUTION/20) #The last term is to handle fractional angstroms
+                timearr -= self.binning.timeOffset
+                timearr *= self.binning.angstroms()*(RESOLUTION/20) #The last term is to handle fractional angstroms
                 return timearr
+        def binevents(self,events):
+                """Find the cube bin of each event in a block of EVENT records
+
+                Returns the flattened (y,x,wavelength) index of every event
+                which lands inside the cube.  Events outside the wavelength
+                range are dropped.  The wavelength bins come straight from
+                the binning's TOF lookup table, with no float arithmetic.
+
+                """
+                start = default_timer()
+                Z = events["position"] & 0xFFFF#position data
+                start = self.timestage("decode",start)
+                bins = self.binning.bins(events["time"])
+                start = self.timestage("tof",start)
+        #
+                #np.histogram includes the right edge in its last bin, so
+                #position 8*256 was always counted as 8*256-1
+                keep = np.logical_and(bins >= 0, Z <= 8*256)
+                Z = np.minimum(Z[keep],8*256-1)
+                index = pixelmap(self.tubemap)[Z]*self.binning.resolution
+                index += bins[keep]
+                self.timestage("remap",start)
+                return index
+
+        def timestage(self,stage,start):
+                """Add the time since start to a stage of the stats
+
+                Returns the current time, so that the next stage can
+                start from it.
+
+                """
+                now = default_timer()
+                self.stats.seconds[stage] += now-start
+                return now
+
+        def finish(self,start):
+                """Add the time since start to the elapsed time and report it"""
+                self.stats.elapsed += default_timer()-start
+                self.statsfunc(self.stats)
+
+        def chunks(self,first=0):
+                """Iterate over the raw data in blocks of chunksize events
+
+                The events are handed out as EVENT records, starting from
+                event first, and progress is passed to statusfunc as the
+                share of the file's bytes which have been processed.  An
+                event index is always read from the start.  A combined
+                cube has no events to hand out.
+
+                """
+                if self.cube is not None:
+                        raise ValueError(self.path + " holds a cube, not events")
+                if self.index is not None:
+                        total = self.index.events
+                        blocks = self.index.blocks(self.chunksize)
+                        #Only the TOFs are stored, the pixels come from offsets
+                        width = self.index.tof.itemsize
+                else:
+                        total = len(self.getevents())-first
+                        blocks = self.eventblocks(first)
+                        width = EVENT.itemsize
+                done = 0
+                start = default_timer()
+                for block in blocks:
+                        self.timestage("read",start)
+                        self.stats.events += len(block)
+                        self.stats.bytes += len(block)*width
+                        yield block
+                        done += len(block)
+                        self.statusfunc(1000.0*done/total)
+                        start = default_timer()
+
+        def eventblocks(self,first=0):
+                """The raw events from event first on, in blocks of chunksize
+
+                The blocks of a combined dataset come from one member file
+                at a time, so the chain is never copied into memory.
+
+                """
+                if self.chain is not None:
+                        return self.chain.blocks(first,self.chunksize)
+                events = self.getevents()[first:]
+                return (events[start:start+self.chunksize]
+                        for start in range(0,len(events),self.chunksize))
+
+        def count(self,keep=None,first=0):
+                """Count the raw data into the cube or a spectrum
+
+                Without keep, returns the int64 counts of the flattened
+                cube.  Otherwise keep is a boolean array over the flattened
+                cube and the wavelength spectrum of the events which land
+                in it is returned.  Only the events from event first
+                onwards are counted.
+
+                """
+                if self.workers > 1 and self.path is not None and \
+                   self.index is None:
+                        return self.parallelcount(keep,first)
+                resolution = self.binning.resolution
+                if keep is None:
+                        counts = np.zeros(128*16*resolution,dtype=np.int64)
+                else:
+                        counts = np.zeros(resolution,dtype=np.int64)
+                for events in self.chunks(first):
+                        index = self.binevents(events)
+                        start = default_timer()
+                        if keep is not None:
+                                index = index[keep[index]] % resolution
+                        counts += np.bincount(index,minlength=len(counts))
+                        self.timestage("histogram",start)
+                return counts
+
+        def parallelcount(self,keep=None,first=0):
+                """Split count over a pool of worker processes
+
+                The event file, from event first onwards, is cut into one
+                whole-event byte range per worker.  Each worker maps and
+                counts its own range and the partial counts are summed,
+                which gives exactly the serial result.  Progress is
+                reported as the ranges finish.
+
+                """
+                events = self.getevents()
+                total = len(events)-first
+                bounds = [first+total*i//self.workers
+                          for i in range(self.workers+1)]
+                settings = [(name,getattr(self,name)) for name in SETTINGS]
+                if self.chain is None:
+                        ranges = lambda a,b: [(self.path,a,b)]
+                else:
+                        ranges = self.chain.pieces
+                tasks = [(ranges(a,b),settings,keep)
+                         for (a,b) in zip(bounds[:-1],bounds[1:])
+                         if b > a]
+                resolution = self.binning.resolution
+                if keep is None:
+                        counts = np.zeros(128*16*resolution,dtype=np.int64)
+                else:
+                        counts = np.zeros(resolution,dtype=np.int64)
+                done = 0
+                pool = multiprocessing.Pool(self.workers)
+                try:
+                        for task,(part,stats) in zip(tasks,pool.imap(_countrange,tasks)):
+                                counts += part
+                                self.stats.merge(stats)
+                                done += sum([b-a for (_,a,b) in task[0]])
+                                self.statusfunc(1000.0*done/total)
+                except:
+                        #Don't wait on the other ranges if the load is abandoned
+                        pool.terminate()
+                        raise
+                finally:
+                        pool.close()
+                        pool.join()
+                return counts
+
+        def fingerprint(self):
+                """Describe everything which decides the data file's cube
+
+                This covers the file itself, through its path, size and
+                modification time, and every setting used to bin it.  For
+                a combined dataset, each member file is covered too.
+
+                """
+                stat = os.stat(self.path)
+                files = (os.path.abspath(self.path),stat.st_size,
+                         stat.st_mtime)
+                if self.chain is not None:
+                        for path in self.chain.paths:
+                                stat = os.stat(path)
+                                files += (os.path.abspath(path),stat.st_size,
+                                          stat.st_mtime)
+                return files+(tuple(TUBEMAPS[self.tubemap]),
+                              self.binning.fingerprint())
+
+        def cached(self):
+                """The data file's cube from the cache, or None
+
+                A combined cube is always at hand.
+
+                """
+                if self.cube is not None:
+                        return self.cube
+                if self.cache is None or self.path is None:
+                        return None
+                return self.cache.load(self.fingerprint())
+
         def make3d(self):
-                """Make a 3D histogram from the raw data."""
-                start=clock()                
-                statusfunc = self.statusfunc
-                l = len(self.data)
-                sd =self.data
-                i=0;
-        
-                cube = np.zeros([128,16,RESOLUTION],dtype=np.float32)
-        
-                #If there's no data, return an empty array
-                if l==0:
+                """Make a 3D histogram from the raw data.
+
+                Every event is given a single index combining its detector
+                pixel and wavelength bin, so the whole cube is counted by
+                one pass of bincount instead of a pass per wavelength.
+                The events are streamed through in blocks of chunksize,
+                so the memory needed doesn't grow with the file.  With
+                more than one worker the file is split between processes.
+                If there's a cache, a cube it already holds is used and
+                new cubes are stored in it.
+
+                """
+                start = default_timer()
+                cube = self.cached()
+                if cube is not None:
+                        self.stats.cached = True
+                        self.statusfunc(1000)
+                        self.finish(start)
                         return cube
-        #
-                Z = self.data[1::2] & 0xFFFF#position data
-        
-                timearr = self.convertTime(np.asarray(self.data[0::2], \
-                                                      dtype=np.float64))#time data
-                timearr = np.asarray(np.floor(timearr),np.uint16)
-        #
-                #Loop over 20 angstroms in steps of 0.1 angstroms
-                np.seterr(over='raise')
-        #
-                for i in range(RESOLUTION):
-                        place = np.where(timearr==i)
-                        if len(place[0]) > 0:
-                                temp,_ = np.histogram(Z[place],bins = \
-                                                      np.arange(8*256+1))
-                                temp = temp.reshape(256,8,order="F")
-                                cube[:,:,i] = mapim(temp)[::-1,:]
-                        statusfunc(i*1000.0/RESOLUTION)
-                                
-        
-                stop=clock()
-                del timearr
-        
+                cube = self.count()
+                cube = cube.reshape(128,16,self.binning.resolution)
+                cube = np.asarray(cube,np.float32)
+                if self.cache is not None and self.path is not None:
+                        self.cache.save(self.fingerprint(),cube)
+                self.finish(start)
+                return cube
+
+        def preview(self,events=2**20,blocks=64):
+                """A quick estimate of the cube from a sample of the events
+
+                About events events are counted, in blocks contiguous
+                runs spread evenly through the file, so that only a small
+                part of it is read.  The counts are scaled up to the size
+                of the whole file.  A cube already in the cache is exact,
+                so it's returned instead.  An event index is sorted by
+                pixel and can't be sampled, so its cube is made in full.
+
+                """
+                start = default_timer()
+                cube = self.cached()
+                if cube is not None:
+                        self.stats.cached = True
+                        self.finish(start)
+                        return cube
+                if self.index is not None:
+                        return self.make3d()
+                data = self.getevents()
+                total = len(data)
+                resolution = self.binning.resolution
+                counts = np.zeros(128*16*resolution,dtype=np.int64)
+                if total <= events:
+                        firsts = [0]
+                        size = total
+                else:
+                        size = max(events//blocks,1)
+                        firsts = np.unique(np.linspace(0,total-size,blocks)
+                                           .astype(np.int64))
+                for first in firsts:
+                        index = self.binevents(data[first:first+size])
+                        counts += np.bincount(index,minlength=len(counts))
+                sampled = len(firsts)*size
+                self.stats.events += sampled
+                self.stats.bytes += sampled*EVENT.itemsize
+                cube = np.asarray(counts.reshape(128,16,resolution),np.float32)
+                if sampled > 0:
+                        cube *= total/float(sampled)
+                self.finish(start)
+                return cube
+
+        def runningkey(self):
+                """The cache key of the running counts kept by update
+
+                Unlike the fingerprint, this leaves out the size and
+                modification time, which change as the file grows.
+
+                """
+                return ("running",os.path.abspath(self.path),
+                        tuple(TUBEMAPS[self.tubemap]),
+                        self.binning.fingerprint())
+
+        def headcheck(self,events):
+                """A checksum of the start of the data, up to events events
+
+                This tells whether the file still begins with the events
+                that were counted, or has been replaced.
+
+                """
+                head = np.asarray(self.data[:2*min(events,512)])
+                return zlib.crc32(head.tobytes()) & 0xFFFFFFFF
+
+        def update(self,finished=False):
+                """Count the events added to a growing file since the last update
+
+                The cube of every event so far is returned, but only the
+                events appended since the last update are read.  The
+                running counts are kept on the PelFile and, if there's a
+                cache, in the cache, so that a new PelFile on the same
+                file carries on where the last one stopped.  If the file
+                no longer starts with the events which were counted, it
+                is counted again from the start.
+
+                Once the file has stopped growing, update it with finished
+                set.  Its cube is then kept in the cache under its
+                fingerprint, where make3d and make1d find it, and the
+                running counts are dropped.
+
+                """
+                if self.path is None or self.index is not None or \
+                   self.chain is not None or self.cube is not None:
+                        raise ValueError("Only event files can be updated")
+                start = default_timer()
+                if finished:
+                        cube = self.cached()
+                        if cube is not None:
+                                self.stats.cached = True
+                                self.finish(start)
+                                return cube
+                if self.running is None and self.cache is not None:
+                        state = self.cache.loadstate(self.runningkey())
+                        if state is not None:
+                                self.running = (int(state["events"]),
+                                                state["counts"],
+                                                int(state["check"]))
+                #Map the file again to see the new events
+                self.data = mapevents(self.path).view(np.int32)
+                total = len(self.getevents())
+                resolution = self.binning.resolution
+                if self.running is None or self.running[0] > total or \
+                   self.headcheck(self.running[0]) != self.running[2]:
+                        self.running = (0,np.zeros(128*16*resolution,np.int64),0)
+                (events,counts,_) = self.running
+                if total > events:
+                        counts = counts+self.count(first=events)
+                        self.running = (total,counts,self.headcheck(total))
+                        if self.cache is not None and not finished:
+                                self.cache.savestate(self.runningkey(),
+                                                     events=total,counts=counts,
+                                                     check=self.running[2])
+                cube = np.asarray(counts.reshape(128,16,resolution),np.float32)
+                if finished and self.cache is not None:
+                        self.cache.save(self.fingerprint(),cube)
+                        self.cache.dropstate(self.runningkey())
+                self.finish(start)
                 return cube
         
         def spectrum(self,output):
-                """Save the neutron spectrum to a text file"""
+                """Save the neutron spectrum to a text file
+
+                The events are histogrammed a block at a time, so the
+                memory needed doesn't grow with the file.
+
+                """
                 with open(output,'w') as of:
-                        timearr = (self.data >> 32) & 0x7FFFFFFF
-                        timearr = self.convertTime(timearr)
-                        timearr /= 10
+                        lmbda = np.arange(2.0,50.0,0.1)
+                        spec = np.zeros(len(lmbda)-1,dtype=np.int64)
+                        for events in self.eventblocks():
+                                timearr = np.asarray(events["time"],np.float64)
+                                timearr = self.convertTime(timearr)
+                                timearr /= 10
         
-                        #Get the spectrum and wavelengths
-                        (spec,lmbda) = np.histogram(timearr,bins = \
-                                                    np.arange(2.0,50.0,0.1))
+                                #Get the spectrum and wavelengths
+                                spec += np.histogram(timearr,bins=lmbda)[0]
                         hist = np.column_stack((lmbda[1:],spec))
                         for point in hist:
                                 of.write("%f %i\n" % (point[0],point[1]))
@@ -268,8 +845,21 @@ class PelFile:
                 the progress in loading the PelFile.  The progress is given
                 on a scale of 0 to 1000.  This function should be overwritten
                 by whatever function is loading the pel file to do what it
-                needs with the load time information.
+                needs with the load time information.  Raising LoadCancelled
+                from it stops the load.
         
+                """
+                return
+
+        def statsfunc(self,stats):
+                """Stats update function
+
+                This function is called with self.stats, a LoadStats,
+                whenever a histogram has been made from the file.  The
+                stats cover all of the work done on the file since it was
+                read.  Like statusfunc, it should be overwritten by
+                whatever wants to show where the load time went.
+
                 """
                 return
         def getgains(self,h):
@@ -279,28 +869,212 @@ class PelFile:
 
 
         def readfileimage(self,path):
-                """Reads a raw Pel File into memory."""
-                start=clock()
-                statusfunc = self.statusfunc
-                with open(path,"rb") as infile:
-                    #self.header = self.parseHeader(infile.read(256))
-                    #Raw File has no header
-                    #point = infile.read(8)
-                    self.data = np.fromfile(infile,np.int32,-1)
-                infile.close()
-                stop=clock()
+                """Map a raw event file into memory.
+
+                The file is not actually read here.  self.data is a flat
+                int32 view of the mapped events, so the pages are only
+                loaded from the disk as a reduction reaches them.  An
+                event index, as made by writeindex, can be opened too, as
+                can a combined dataset descriptor, whose member files are
+                chained together.  A combined cube, or a cube archive from
+                histbatch, is read whole, and its binning and tube map
+                replace the PelFile's own.
+
+                """
+                start = default_timer()
+                self.stats = LoadStats()
+                self.path = path
+                self.index = None
+                self.chain = None
+                self.cube = None
+                if path.endswith(".idx"):
+                        #The events are only reached through chunks
+                        self.index = EventIndex(path)
+                        self.data = np.zeros(0,dtype=np.int32)
+                elif dataset.isdataset(path):
+                        #The events are only reached through getevents
+                        self.chain = EventChain(dataset.eventfiles(path))
+                        self.data = np.zeros(0,dtype=np.int32)
+                elif path.endswith(".npz"):
+                        (self.cube,self.binning,self.tubemap) = \
+                            dataset.readcube(path)
+                        self.data = np.zeros(0,dtype=np.int32)
+                else:
+                        #Raw File has no header
+                        self.data = mapevents(path).view(np.int32)
+                self.timestage("read",start)
+                self.stats.elapsed += default_timer()-start
+
+        def getevents(self):
+                """The raw data as an array of EVENT records
+
+                The fields are views into the raw data and are only
+                decoded when used.  A combined dataset gives its
+                EventChain, which slices in the same way.
+
+                """
+                if self.chain is not None:
+                        return self.chain
+                return self.data[:len(self.data)//2*2].view(EVENT)
+
+        def roimask(self,mins,maxs,mask=None):
+                """Turn a region of interest into a 128x16 pixel mask
+
+                If a mask is given it is used as is, otherwise the pixels
+                from mins to maxs, as (x,y) pairs, are chosen.
+
+                """
+                if mask is not None:
+                    return np.asarray(mask,dtype=bool)
+                xmin,ymin = mins
+                xmax,ymax = maxs
+                mask = np.zeros((128,16),dtype=bool)
+                mask[ymin:ymax,xmin:xmax] = True
+                return mask
 
         def make1d(self,mins,maxs,mask=None):
-                """Make a 1D histogram from the spectrum data."""
-        
-                c = self.make3d()
-                if mask is None:
-                    xmin,ymin = mins
-                    xmax,ymax = maxs
-                    c = c[ymin:ymax,xmin:xmax]
+                """Make a 1D histogram from the spectrum data.
+
+                The region of interest, or the mask if one is given, is
+                applied to the events themselves and only the wavelengths
+                of the events which pass are counted, so the cube is never
+                built.  A cube already in the cache is used instead.
+
+                """
+                start = default_timer()
+                mask = self.roimask(mins,maxs,mask)
+                cube = self.cached()
+                if cube is not None:
+                    self.stats.cached = True
+                    spec = np.sum(cube[mask],axis=0,dtype=np.float64)
                 else:
-                    c[np.logical_not(mask)] = 0
-                return np.sum(np.sum(c,axis=0,dtype=np.float64()),axis=0)
+                    #Stretch the pixel mask over every wavelength bin of the
+                    #cube, so it can be looked up with binevents' indices
+                    keep = np.repeat(np.ravel(mask),self.binning.resolution)
+                    spec = np.asarray(self.count(keep),dtype=np.float64)
+                self.finish(start)
+                return spec
+
+        def image(self,lmin,lmax):
+                """The 2D detector image over wavelength bins lmin to lmax-1
+
+                With an event index, each pixel only needs a binary search
+                at either end of the band.  Otherwise the cube is made.
+
+                """
+                if self.index is None:
+                        return np.sum(self.make3d()[:,:,lmin:lmax],axis=2, \
+                                      dtype=np.float64)
+                begin = default_timer()
+                (tofmin,tofmax) = self.binning.tofrange(lmin,lmax)
+                image = np.zeros(128*16,dtype=np.float64)
+                counts = self.index.counts(tofmin,tofmax)
+                self.stats.events += int(np.sum(counts))
+                start = self.timestage("histogram",begin)
+                image[pixelmap(self.tubemap)] = counts
+                self.timestage("remap",start)
+                self.finish(begin)
+                return image.reshape(128,16)
+
+        def roicount(self,mins,maxs,lmin,lmax,mask=None):
+                """Count the events in a region over wavelength bins lmin to lmax-1
+
+                The region is given as for make1d.
+
+                """
+                return np.sum(self.image(lmin,lmax)[self.roimask(mins,maxs,mask)])
+
+        def reduce(self,products):
+                """Make several histograms in a single pass over the events
+
+                Each product is a tuple naming a histogram followed by
+                its parameters:
+                ("cube",) -- the 3D histogram from make3d
+                ("image",lmin,lmax) -- the 2D image over wavelength bins
+                                       lmin to lmax-1
+                ("spectrum",mins,maxs,mask) -- the spectrum from make1d
+                ("tubes",) -- the counts on each of the 16 tubes
+                ("tof",width) -- the raw TOF histogram, in bins of width
+                                 tenths of a microsecond from zero
+                ("total",) -- the number of events in the file
+                A list of the results is returned in the same order.
+
+                """
+                begin = default_timer()
+                resolution = self.binning.resolution
+                results = []
+                for product in products:
+                        kind = product[0]
+                        if kind == "cube":
+                                results.append(np.zeros(128*16*resolution,np.int64))
+                        elif kind == "image":
+                                results.append(np.zeros(128*16,np.int64))
+                        elif kind == "spectrum":
+                                results.append(np.zeros(resolution,np.int64))
+                        elif kind == "tubes":
+                                results.append(np.zeros(16,np.int64))
+                        elif kind == "tof":
+                                results.append(np.zeros(0,np.int64))
+                        elif kind == "total":
+                                results.append(0)
+                        else:
+                                raise ValueError("Unknown product: " + str(kind))
+                keeps = [np.repeat(np.ravel(self.roimask(*product[1:])),resolution)
+                         if product[0] == "spectrum" else None
+                         for product in products]
+                #Only bin the events if some product needs them
+                binned = [product for product in products
+                          if product[0] not in ("tof","total")]
+                for events in self.chunks():
+                        if binned:
+                                index = self.binevents(events)
+                                start = default_timer()
+                                pixel,bins = np.divmod(index,resolution)
+                                start = self.timestage("remap",start)
+                        else:
+                                start = default_timer()
+                        for i,product in enumerate(products):
+                                kind = product[0]
+                                if kind == "cube":
+                                        results[i] += np.bincount(index, \
+                                                minlength=128*16*resolution)
+                                elif kind == "image":
+                                        (lmin,lmax) = product[1:]
+                                        band = np.logical_and(bins >= lmin,bins < lmax)
+                                        results[i] += np.bincount(pixel[band], \
+                                                minlength=128*16)
+                                elif kind == "spectrum":
+                                        results[i] += np.bincount( \
+                                                bins[keeps[i][index]], \
+                                                minlength=resolution)
+                                elif kind == "tubes":
+                                        results[i] += np.bincount(pixel % 16, \
+                                                                  minlength=16)
+                                elif kind == "tof":
+                                        tof = events["time"]
+                                        tof = tof[tof >= 0]//product[1]
+                                        tof = np.bincount(tof)
+                                        if len(tof) > len(results[i]):
+                                                tof[:len(results[i])] += results[i]
+                                                results[i] = tof
+                                        else:
+                                                results[i][:len(tof)] += tof
+                                elif kind == "total":
+                                        results[i] += len(events)
+                        self.timestage("histogram",start)
+                for i,product in enumerate(products):
+                        kind = product[0]
+                        if kind == "cube":
+                                results[i] = np.asarray(results[i].reshape( \
+                                        128,16,resolution),np.float32)
+                        elif kind == "image":
+                                results[i] = np.asarray(results[i].reshape( \
+                                        128,16),np.float64)
+                        elif kind in ("spectrum","tubes"):
+                                results[i] = np.asarray(results[i],np.float64)
+                self.finish(begin)
+                return results
+
 if __name__=="__main__":
         data = PelFile()
         
@@ -0,0 +1,213 @@
+"""A catalog of run metadata, kept in SQLite
+
+Usage: python runcatalog.py pattern [pattern ...]
+
+This module contains a single class: RunCatalog.  Reading the start
+and stop times and the instrument currents of a run means parsing its
+runinfo XML, and its monitor and event totals mean reading its data
+files.  A RunCatalog does that once for each run and keeps the results
+in a SQLite database, one row per runinfo file.  A row is only brought
+up to date when the runinfo, monitor or event file of its run changes
+size or modification time, so a catalog query costs a few stat calls.
+Many runs are looked up at once on a pool of threads, since on a
+network share most of the time goes waiting on the server.
+
+Runs are named by the path of their runinfo file, as in Combiner.
+
+"""
+
+import __future__
+import glob
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from time import strptime,mktime
+
+import numpy as np
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+XMLNS = "{http://neutrons.ornl.gov/SNS/DAS/runinfo_v4_3}"
+CATALOG = os.path.join(os.path.expanduser("~"),".pelvis","runs.sqlite")
+WORKERS = 8 #Threads checking and reading run files at once
+
+#The metadata of a run.  start and stop are seconds since the epoch,
+#manifest is the dictionary of currents from the run's Notes, monitor
+#is the total monitor count and events the number of detector events.
+#Any of them may be None if the run doesn't record it.
+Run = namedtuple("Run","path start stop duration manifest monitor events")
+
+def datapaths(path):
+    """The monitor and event files of a runinfo file"""
+    base = path[:-len("runinfo.xml")]
+    return (base+"bmon_histo.dat",base+"neutron_event.dat")
+
+def stamp(path):
+    """The size and modification time of a file, or None if it's missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size,stat.st_mtime)
+
+def parsetime(text):
+    """Seconds since the epoch of a runinfo time stamp
+
+    The time zone suffix is ignored, as it was when the stamps were
+    parsed with strptime, and some stamps carry it twice.
+
+    """
+    if text is None or text.strip() == "":
+        return None
+    return mktime(strptime(text.strip()[:19],"%Y-%m-%dT%H:%M:%S"))
+
+def readrun(path):
+    """Read the metadata of a run from its files
+
+    Returns None if the runinfo file is missing or not yet completely
+    written.
+
+    """
+    try:
+        root = ET.parse(path).getroot()
+    except (IOError,OSError,ET.ParseError):
+        return None
+    def text(tag):
+        node = root.find(".//"+XMLNS+tag)
+        if node is None:
+            return None
+        return node.text
+    start = parsetime(text("StartTime"))
+    stop = parsetime(text("StopTime"))
+    if start is None or stop is None:
+        duration = None
+    else:
+        duration = stop-start
+    notes = text("Notes")
+    try:
+        manifest = json.loads(unescape(notes))
+    except (TypeError,ValueError):
+        manifest = None
+    (monpath,detpath) = datapaths(path)
+    if os.path.isfile(monpath):
+        monitor = int(np.sum(np.fromfile(monpath,dtype=np.int32)))
+    else:
+        monitor = None
+    if os.path.isfile(detpath):
+        events = os.path.getsize(detpath)//8 #int32 time and position
+    else:
+        events = None
+    return Run(path,start,stop,duration,manifest,monitor,events)
+
+class RunCatalog:
+    """Run metadata kept up to date in a SQLite database"""
+    def __init__(self,path=CATALOG):
+        """Open the catalog in path, creating it if needed"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs ("
+                        "path TEXT PRIMARY KEY, stamp TEXT, "
+                        "start REAL, stop REAL, duration REAL, "
+                        "manifest TEXT, monitor INTEGER, events INTEGER)")
+        self.db.commit()
+
+    def stamps(self,path):
+        """The sizes and modification times of all the files of a run"""
+        return repr([stamp(p) for p in (path,)+datapaths(path)])
+
+    def run(self,path):
+        """The metadata of the run with a runinfo file, or None
+
+        The run is read from its files if it isn't in the catalog or
+        any of its files have changed since it was.
+
+        """
+        path = os.path.abspath(path)
+        current = self.stamps(path)
+        run = self.lookup(path,current)
+        if run is not None:
+            return run
+        run = readrun(path)
+        if run is not None:
+            self.store(run,current)
+            self.db.commit()
+        return run
+
+    def lookup(self,path,current):
+        """The catalogued metadata of a run, or None if it's out of date"""
+        row = self.db.execute("SELECT stamp,start,stop,duration,manifest,"
+                              "monitor,events FROM runs WHERE path=?",
+                              (path,)).fetchone()
+        if row is None or row[0] != current:
+            return None
+        manifest = row[4]
+        if manifest is not None:
+            manifest = json.loads(manifest)
+        return Run(path,row[1],row[2],row[3],manifest,row[5],row[6])
+
+    def store(self,run,current):
+        """Catalog the metadata of a run, whose files had the given stamps"""
+        if run.manifest is None:
+            manifest = None
+        else:
+            manifest = json.dumps(run.manifest)
+        self.db.execute("INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?)",
+                        (run.path,current,run.start,run.stop,run.duration,
+                         manifest,run.monitor,run.events))
+
+    def runs(self,paths,workers=WORKERS):
+        """The metadata of several runs, with None for unreadable ones
+
+        The files are checked, and those of runs which are out of date
+        read, on a pool of threads.  The database is only used from
+        the calling thread.
+
+        """
+        paths = [os.path.abspath(p) for p in paths]
+        pool = ThreadPool(workers)
+        try:
+            current = pool.map(self.stamps,paths)
+            results = [self.lookup(p,s) for (p,s) in zip(paths,current)]
+            stale = [i for (i,run) in enumerate(results) if run is None]
+            for (i,run) in zip(stale,pool.map(readrun,[paths[i] for i in stale])):
+                if run is not None:
+                    self.store(run,current[i])
+                results[i] = run
+        finally:
+            pool.close()
+            pool.join()
+        self.db.commit()
+        return results
+
+_shared = None
+_owner = None #The process which opened _shared
+
+def shared():
+    """The catalog in CATALOG, opened when first needed
+
+    A SQLite connection mustn't be carried across a fork, so a worker
+    process opens the catalog again for itself.
+
+    """
+    global _shared, _owner
+    if _shared is None or _owner != os.getpid():
+        _shared = RunCatalog()
+        _owner = os.getpid()
+    return _shared
+
+if __name__=="__main__":
+    files = sorted(set([x for pattern in sys.argv[1:] for x in glob.glob(pattern)]))
+    catalog = shared()
+    for run in catalog.runs([x for x in files if x.endswith("runinfo.xml")]):
+        if run is not None:
+            print("%s\t%s\t%s\t%s" % (run.path,run.duration,run.monitor,run.events))
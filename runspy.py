@@ -1,14 +1,11 @@
 from optparse import OptionParser
-import xml.etree.ElementTree as ET
-import HTMLParser
-import json
 import os.path
 import matplotlib.pyplot as plt
 import numpy as np
+import runcatalog
 
 
 basedir = "C:/userfiles/EXP011/"
-XMLNS = "{http://neutrons.ornl.gov/SNS/DAS/runinfo_v4_3}"
 
 def plot(d):
     form = {-5:"r*",5:"kh"}
@@ -19,17 +16,16 @@ def plot(d):
     plt.yticks(fontsize="20")
     for k in d.keys(): 
         paths = [os.path.join(basedir,"SESAME_%i"%run,
-                     "SESAME_%i_neutron_event.dat"%run)
-                 for run in d[k]]
-        mons = [os.path.join(basedir,"SESAME_%i"%run,
-                     "SESAME_%i_bmon_histo.dat"%run)
+                     "SESAME_%i_runinfo.xml"%run)
                  for run in d[k]]
+        #The event and monitor totals are kept in the run catalog
+        infos = runcatalog.shared().runs(paths)
         points = np.asarray(
-            [len(np.fromfile(path,count=-1,dtype=np.int32)[::2])
-             for path in paths],dtype=np.float64)
+            [np.nan if info is None or info.events is None else info.events
+             for info in infos],dtype=np.float64)
         norms = np.asarray(
-            [np.sum(np.fromfile(path,count=-1,dtype=np.int32))
-             for path in mons])
+            [np.nan if info is None or info.monitor is None else info.monitor
+             for info in infos],dtype=np.float64)
         plt.errorbar(d[k],points/norms,yerr=np.sqrt(points)/norms,fmt=form[k],markersize=10)
     plt.legend(labels.values(),numpoints=1)
     plt.show()
@@ -37,16 +33,14 @@ def plot(d):
 
 def process(runs):
     d = {}
-    for run in runs:
-        path = os.path.join(basedir,"SESAME_%i"%run,
-                            "SESAME_%i_runinfo.xml"%run)
-        text = ET.parse(path).getroot().find(".//"+XMLNS+"Notes").text 
-        text = HTMLParser.HTMLParser().unescape(text)
-        try:
-            manifest = json.loads(text)
-        except:
+    paths = [os.path.join(basedir,"SESAME_%i"%run,
+                          "SESAME_%i_runinfo.xml"%run)
+             for run in runs]
+    for (run,info) in zip(runs,runcatalog.shared().runs(paths)):
+        if info is None or info.manifest is None:
             print("No current information stored for run %i"%run)
-            continue #Yes, I know this is an anti-pattern,
+            continue
+        manifest = info.manifest
         
         flip = manifest['Flipper']
         old = d.get(flip,[])[:]